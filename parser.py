@@ -6,10 +6,12 @@ Incluye validaciones y reflexiones automáticas
 """
 
 import re
-import json
 from typing import List, Dict, Optional
 from collections import Counter
 
+import ahocorasick
+import orjson
+
 # Dominios oficiales AWS CLF-C02
 OFFICIAL_DOMAINS = {
     "Domain 1: Cloud Concepts": {
@@ -64,6 +66,49 @@ VALID_AWS_SERVICES = {
     "AWS Cost Explorer", "AWS Budgets", "AWS Organizations"
 }
 
+# Patrones precompilados (se evalúan en cada línea del archivo)
+_QUESTION_RE = re.compile(r'^(\d+)\.\s+(¿.+)$')
+_OPTION_RE = re.compile(r'^([A-D])\)\s+(.+)')
+_NEW_Q_RE = re.compile(r'^\d+\.')
+_ANS_LETTER_RE = re.compile(r'([A-D])\)')
+
+# Letras de opción que toda pregunta debe tener
+_EXPECTED_LETTERS = frozenset('ABCD')
+
+# Alias de cada servicio (nombre completo y sin prefijo "Amazon "/"AWS ")
+_SERVICE_ALIASES = {
+    alias: service
+    for service in VALID_AWS_SERVICES
+    for alias in {service, service.replace('Amazon ', ''), service.replace('AWS ', '')}
+}
+
+# Automata Aho-Corasick: detecta todos los alias en una sola pasada sobre el texto
+_SERVICES_AC = ahocorasick.Automaton()
+for _alias, _service in _SERVICE_ALIASES.items():
+    _SERVICES_AC.add_word(_alias, _service)
+_SERVICES_AC.make_automaton()
+
+# Keywords de cada dominio ya en minúsculas
+_DOMAIN_KEYWORDS_LOWER = {
+    domain: [keyword.lower() for keyword in info['keywords']]
+    for domain, info in OFFICIAL_DOMAINS.items()
+}
+
+# Automata de keywords por dominio (sobre texto en minúsculas)
+_DOMAIN_AC = ahocorasick.Automaton()
+for _domain, _keywords in _DOMAIN_KEYWORDS_LOWER.items():
+    for _keyword in _keywords:
+        _DOMAIN_AC.add_word(_keyword, (_keyword, _domain))
+_DOMAIN_AC.make_automaton()
+
+# Keywords distintas de un mismo dominio que bastan para clasificar
+_CONFIDENT_KEYWORD_HITS = 3
+
+
+def _is_option_line(line: str) -> bool:
+    """Equivale a re.match(r'^[A-D]\\)', line) sin pasar por el motor de regex"""
+    return len(line) >= 2 and line[1] == ')' and 'A' <= line[0] <= 'D'
+
 
 class QuestionParser:
     def __init__(self, txt_file_path: str):
@@ -73,84 +118,78 @@ class QuestionParser:
         self.reflection_notes = []
 
     def parse(self) -> List[Dict]:
-        """Parse el archivo de texto y extrae preguntas"""
-        with open(self.txt_file_path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-
+        """Parse el archivo de texto y extrae preguntas (una sola pasada)"""
         current_question = None
-        i = 0
-
-        while i < len(lines):
-            line = lines[i].strip()
-
-            # Detectar inicio de pregunta: número. ¿...?
-            question_match = re.match(r'^(\d+)\.\s+(¿.+)$', line)
-
-            if question_match:
-                # Si hay una pregunta anterior, procesarla
-                if current_question and current_question.get('options'):
-                    self._process_question(current_question)
-
-                # Iniciar nueva pregunta
-                question_text = question_match.group(2).strip()
-
-                # Si la pregunta continúa en la siguiente línea
-                j = i + 1
-                while j < len(lines) and not re.match(r'^[A-D]\)', lines[j].strip()):
-                    next_line = lines[j].strip()
-                    if next_line and not next_line.startswith('✔') and not next_line.startswith('📌'):
-                        question_text += ' ' + next_line
-                    if '?' in next_line:
-                        break
-                    j += 1
-
-                current_question = {
-                    'number': int(question_match.group(1)),
-                    'question': question_text,
-                    'options': {},
-                    'correct_answer': None,
-                    'explanation': '',
-                    'context': ''
-                }
-
-            # Detectar opciones de respuesta (A) B) C) D))
-            elif current_question and re.match(r'^[A-D]\)', line):
-                option_match = re.match(r'^([A-D])\)\s+(.+)', line)
-                if option_match:
-                    letter = option_match.group(1)
-                    text = option_match.group(2).strip()
-
-                    # Detectar si tiene ✅ (respuesta correcta)
-                    if '✅' in text:
-                        current_question['correct_answer'] = letter
-                        text = text.replace('✅', '').strip()
-
-                    current_question['options'][letter] = text
-
-            # Detectar explicación
-            elif current_question and line.startswith('✔ Correcta:'):
-                explanation = line.replace('✔ Correcta:', '').strip()
-
-                # Buscar respuesta correcta si no se encontró antes
-                answer_match = re.search(r'([A-D])\)', explanation)
-                if answer_match and not current_question['correct_answer']:
-                    current_question['correct_answer'] = answer_match.group(1)
-
-                # Continuar leyendo la explicación en líneas siguientes
-                j = i + 1
-                while j < len(lines):
-                    next_line = lines[j].strip()
-                    if next_line.startswith('❌') or next_line.startswith('📌'):
-                        j += 1
-                        continue
-                    if re.match(r'^\d+\.', next_line) or not next_line:
-                        break
-                    explanation += ' ' + next_line
-                    j += 1
-
-                current_question['explanation'] = explanation
-
-            i += 1
+        # Estados de continuación: texto de pregunta / explicación multilínea
+        in_question_text = False
+        in_explanation = False
+
+        with open(self.txt_file_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+
+                # Continuación de la pregunta hasta la primera opción o '?'
+                if in_question_text:
+                    if _is_option_line(line):
+                        in_question_text = False
+                    else:
+                        if line and not line.startswith('✔') and not line.startswith('📌'):
+                            current_question['question'] += ' ' + line
+                        if '?' in line:
+                            in_question_text = False
+
+                # Continuación de la explicación hasta nueva pregunta o línea vacía
+                if in_explanation and not (line.startswith('❌') or line.startswith('📌')):
+                    if not line or (line[0].isdigit() and _NEW_Q_RE.match(line)):
+                        in_explanation = False
+                    else:
+                        current_question['explanation'] += ' ' + line
+
+                # Detectar inicio de pregunta: número. ¿...?
+                # (filtro barato por primer carácter antes del regex)
+                question_match = line[:1].isdigit() and _QUESTION_RE.match(line)
+
+                if question_match:
+                    # Si hay una pregunta anterior, procesarla
+                    if current_question and current_question.get('options'):
+                        self._process_question(current_question)
+
+                    # Iniciar nueva pregunta
+                    current_question = {
+                        'number': int(question_match.group(1)),
+                        'question': question_match.group(2).strip(),
+                        'options': {},
+                        'correct_answer': None,
+                        'explanation': '',
+                        'context': ''
+                    }
+                    in_question_text = True
+
+                # Detectar opciones de respuesta (A) B) C) D))
+                elif current_question and _is_option_line(line):
+                    option_match = _OPTION_RE.match(line)
+                    if option_match:
+                        letter = option_match.group(1)
+                        text = option_match.group(2).strip()
+
+                        # Detectar si tiene ✅ (respuesta correcta)
+                        if '✅' in text:
+                            current_question['correct_answer'] = letter
+                            text = text.replace('✅', '').strip()
+
+                        current_question['options'][letter] = text
+
+                # Detectar explicación
+                elif current_question and line.startswith('✔ Correcta:'):
+                    explanation = line.replace('✔ Correcta:', '').strip()
+
+                    # Buscar respuesta correcta si no se encontró antes
+                    answer_match = _ANS_LETTER_RE.search(explanation)
+                    if answer_match and not current_question['correct_answer']:
+                        current_question['correct_answer'] = answer_match.group(1)
+
+                    current_question['explanation'] = explanation
+                    in_explanation = True
 
         # Procesar última pregunta
         if current_question and current_question.get('options'):
@@ -164,12 +203,16 @@ class QuestionParser:
         correct_letter = q_data['correct_answer']
         explanation = q_data['explanation']
 
+        # Texto combinado (pregunta + opciones), se construye una sola vez
+        combined = q_data['question'] + ' ' + ' '.join(options.values())
+        services = self._extract_services(combined)
+
         # Asignar dominio
-        domain = self._classify_domain(q_data['question'] + ' ' + ' '.join(options.values()))
+        domain = self._classify_domain(combined)
 
         # Validar pregunta
-        is_valid, errors = self._validate_question(q_data['number'], q_data['question'],
-                                                     options, correct_letter)
+        is_valid, errors = self._validate_question(q_data['number'], options,
+                                                     correct_letter, services)
 
         if is_valid:
             question_obj = {
@@ -180,7 +223,7 @@ class QuestionParser:
                 'options': options,
                 'correctAnswer': correct_letter,
                 'explanation': explanation,
-                'services': self._extract_services(q_data['question'] + ' ' + ' '.join(options.values()))
+                'services': services
             }
             self.questions.append(question_obj)
         else:
@@ -188,29 +231,32 @@ class QuestionParser:
 
     def _classify_domain(self, text: str) -> str:
         """Clasifica la pregunta en un dominio oficial AWS"""
-        scores = {}
-        text_lower = text.lower()
-
-        for domain, info in OFFICIAL_DOMAINS.items():
-            score = sum(1 for keyword in info['keywords'] if keyword.lower() in text_lower)
-            scores[domain] = score
-
-        # Retornar el dominio con mayor score
-        if max(scores.values()) > 0:
-            return max(scores, key=scores.get)
+        seen = set()
+        scores = Counter()
+
+        for _, (keyword, domain) in _DOMAIN_AC.iter(text.lower()):
+            # Cada keyword cuenta una sola vez por pregunta
+            if keyword in seen:
+                continue
+            seen.add(keyword)
+            scores[domain] += 1
+
+            # Señal clara: no hace falta seguir escaneando
+            if scores[domain] >= _CONFIDENT_KEYWORD_HITS:
+                return domain
+
+        # Retornar el dominio con mayor score (empates: orden oficial)
+        if scores:
+            return max(OFFICIAL_DOMAINS, key=lambda domain: scores[domain])
         else:
             return "Domain 3: Cloud Technology and Services"  # Default
 
     def _extract_services(self, text: str) -> List[str]:
         """Extrae servicios AWS mencionados en el texto"""
-        services = []
-        for service in VALID_AWS_SERVICES:
-            if service in text or service.replace('Amazon ', '') in text or service.replace('AWS ', '') in text:
-                services.append(service)
-        return services
-
-    def _validate_question(self, number: int, question: str, options: Dict,
-                           correct_answer: Optional[str]) -> tuple:
+        return list(dict.fromkeys(service for _, service in _SERVICES_AC.iter(text)))
+
+    def _validate_question(self, number: int, options: Dict,
+                           correct_answer: Optional[str], services: List[str]) -> tuple:
         """Valida una pregunta"""
         errors = []
 
@@ -219,8 +265,7 @@ class QuestionParser:
             errors.append(f"Q{number}: Solo tiene {len(options)} opciones (necesita 4)")
 
         # Validación 2: Debe tener todas las letras A-D
-        expected_letters = set(['A', 'B', 'C', 'D'])
-        if set(options.keys()) != expected_letters:
+        if options.keys() != _EXPECTED_LETTERS:
             errors.append(f"Q{number}: Opciones incompletas {options.keys()}")
 
         # Validación 3: Debe tener respuesta correcta marcada
@@ -232,7 +277,6 @@ class QuestionParser:
             errors.append(f"Q{number}: Respuesta correcta '{correct_answer}' no está en opciones")
 
         # Validación 5: Debe mencionar al menos un servicio AWS válido
-        services = self._extract_services(question + ' ' + ' '.join(options.values()))
         if not services:
             self.reflection_notes.append(f"Q{number}: No menciona servicios AWS específicos")
 
@@ -240,19 +284,18 @@ class QuestionParser:
 
     def generate_reflection_report(self) -> Dict:
         """Genera reporte de reflexión sobre la calidad del contenido"""
-        # Contar preguntas por dominio
-        domain_counts = Counter([q['domain'] for q in self.questions])
+        # Contar dominios y servicios en una sola pasada
+        domain_counts, service_counts = Counter(), Counter()
+        for q in self.questions:
+            domain_counts[q['domain']] += 1
+            service_counts.update(q['services'])
 
-        # Calcular porcentajes
         total = len(self.questions)
-        domain_percentages = {
-            domain: (count / total * 100) for domain, count in domain_counts.items()
-        }
 
-        # Comparar con porcentajes oficiales
+        # Comparar porcentajes reales con los oficiales
         domain_comparison = {}
         for domain, info in OFFICIAL_DOMAINS.items():
-            actual = domain_percentages.get(domain, 0)
+            actual = domain_counts[domain] / total * 100 if domain in domain_counts else 0
             expected = info['weight']
             domain_comparison[domain] = {
                 'actual': round(actual, 1),
@@ -260,12 +303,6 @@ class QuestionParser:
                 'difference': round(actual - expected, 1)
             }
 
-        # Servicios más mencionados
-        all_services = []
-        for q in self.questions:
-            all_services.extend(q['services'])
-        service_counts = Counter(all_services)
-
         return {
             'total_questions': total,
             'valid_questions': len(self.questions),
@@ -289,8 +326,8 @@ class QuestionParser:
             'questions': self.questions
         }
 
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        with open(output_path, 'wb') as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
 
 
 def main():
@@ -335,8 +372,8 @@ def main():
     print("\n✨ Proceso completado!")
 
     # Guardar también el reporte
-    with open("/mnt/c/Users/HG_Co/OneDrive/Documents/Github/aws-clf02/data/reflection_report.json", 'w') as f:
-        json.dump(reflection, f, indent=2, ensure_ascii=False)
+    with open("/mnt/c/Users/HG_Co/OneDrive/Documents/Github/aws-clf02/data/reflection_report.json", 'wb') as f:
+        f.write(orjson.dumps(reflection, option=orjson.OPT_INDENT_2))
 
     print("📄 Reporte de reflexión guardado en: data/reflection_report.json")
 
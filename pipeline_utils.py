@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Utilidades compartidas por los scripts del pipeline (scripts/)
+Reparto proporcional, rate limit y caché de OpenAI, búsqueda RAG en memoria
+"""
+
+import os
+import random
+import hashlib
+import threading
+import time
+from pathlib import Path
+from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import orjson
+
+PROJECT_ROOT = Path(__file__).parent
+LLM_CACHE_DIR = PROJECT_ROOT / "data" / ".cache" / "openai"  # Respuestas ya pagadas
+
+MAX_CONCURRENT_REQUESTS = int(os.getenv("OPENAI_CONCURRENCY", "16"))  # Requests a OpenAI en paralelo
+REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_RPM", "500"))  # Límite del tier de OpenAI
+RATE_LIMIT_RETRIES = 6  # Reintentos ante 429 (backoff exponencial)
+MAX_BACKOFF_SECONDS = 32
+PROMPT_CACHE_MIN_TOKENS = 1024  # OpenAI solo cachea prompts de al menos 1024 tokens
+
+
+def largest_remainder(weights, total: int) -> np.ndarray:
+    """Reparte `total` proporcionalmente a `weights` (método de Hamilton)
+
+    Cada parte recibe el piso de su cuota y las unidades sobrantes van a las
+    partes con mayor residuo (empates: en orden).
+    """
+    weights = np.asarray(weights, dtype=float)
+    quotas = weights / weights.sum() * total
+    counts = np.floor(quotas).astype(int)
+    extras = total - int(counts.sum())
+    counts[np.argsort(counts - quotas, kind="stable")[:extras]] += 1
+    return counts
+
+
+def get_model_encoding(model: str):
+    """Encoding de tiktoken del modelo (o200k_base para la familia gpt-4o)"""
+    import tiktoken
+
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def build_system_prompts(system_prompt: str, examples: List[Dict], domains, count_tokens) -> Dict[str, str]:
+    """System prompt por dominio (instrucciones + ejemplo few-shot) del script 4
+
+    Es idéntico para todas las preguntas del dominio, lo que aprovecha el
+    prompt caching. Si queda por debajo de PROMPT_CACHE_MIN_TOKENS se
+    completa con los ejemplos de los demás dominios.
+    """
+    example_json = {
+        ex["domain"]: orjson.dumps(ex["example"], option=orjson.OPT_INDENT_2).decode()
+        for ex in examples
+    }
+    default_json = orjson.dumps(examples[0]["example"], option=orjson.OPT_INDENT_2).decode()
+
+    prompts = {}
+    for domain in domains:
+        own_json = example_json.get(domain, default_json)
+        prompt = (
+            system_prompt.replace("{domain}", domain)
+            + "\n\nSigue el formato del siguiente ejemplo:\n\n"
+            + own_json
+        )
+        for extra_json in example_json.values():
+            if count_tokens(prompt) >= PROMPT_CACHE_MIN_TOKENS:
+                break
+            if extra_json != own_json:
+                prompt += "\n\nOtro ejemplo del formato (de otro dominio):\n\n" + extra_json
+        prompts[domain] = prompt
+    return prompts
+
+
+def load_checkpoint(jsonl_path: Path) -> List[Dict]:
+    """Carga los registros de un JSONL de checkpoint (para --resume)
+
+    Si el proceso se cortó a mitad de una escritura, la última línea queda
+    incompleta: se descarta y se recorta del archivo, para que lo que se
+    agregue después empiece en una línea propia. Una línea inválida en medio
+    del archivo sigue siendo un error.
+    """
+    if not jsonl_path.exists():
+        return []
+
+    records = []
+    offset = 0
+    with open(jsonl_path, 'rb') as f:
+        for line in f:
+            line_start = offset
+            offset += len(line)
+            if not line.strip():
+                continue
+            try:
+                records.append(orjson.loads(line))
+            except orjson.JSONDecodeError:
+                if f.read().strip():
+                    raise
+                break
+        else:
+            return records
+
+    with open(jsonl_path, 'r+b') as f:
+        f.truncate(line_start)
+    print(f"   ⚠️ Última línea incompleta de {jsonl_path.name} descartada (escritura interrumpida)")
+    return records
+
+
+class RateLimiter:
+    """Token bucket thread-safe: como máximo `rate` requests por minuto"""
+
+    def __init__(self, rate: int, per: float = 60.0):
+        self.capacity = rate
+        self.tokens = float(rate)
+        self.fill_rate = rate / per
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Bloquea solo si el bucket está vacío"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.fill_rate
+            time.sleep(wait)
+
+
+def cache_path_for(request: Dict) -> Path:
+    """Archivo de caché de una request (hash de modelo, mensajes y parámetros)"""
+    key = hashlib.blake2b(orjson.dumps(request, option=orjson.OPT_SORT_KEYS), digest_size=16).hexdigest()
+    return LLM_CACHE_DIR / f"{key}.txt"
+
+
+def store_cached(cache_path: Path, content: str):
+    """Guarda una respuesta en caché (escritura atómica: varios hilos pueden resolver la misma request)"""
+    LLM_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_name(f"{cache_path.stem}.{threading.get_ident()}.tmp")
+    tmp_path.write_text(content, encoding='utf-8')
+    os.replace(tmp_path, cache_path)
+
+
+class RateLimitedClient:
+    """chat.completions de OpenAI con rate limit compartido entre hilos y backoff ante 429
+
+    `retries` y `honor_retry_after` fijan la política ante 429 (por defecto la
+    de los scripts 6 y 6b: respetar el Retry-After que envía OpenAI).
+    """
+
+    def __init__(self, client, rate: int = REQUESTS_PER_MINUTE, retries: int = RATE_LIMIT_RETRIES,
+                 honor_retry_after: bool = True):
+        self.client = client
+        self.rate_limiter = RateLimiter(rate)
+        self.retries = retries
+        self.honor_retry_after = honor_retry_after
+
+    def create_completion(self, **kwargs):
+        """Llama a chat.completions respetando el rate limit, con backoff ante 429"""
+        from openai import RateLimitError
+
+        for attempt in range(self.retries):
+            self.rate_limiter.acquire()
+            try:
+                return self.client.chat.completions.create(**kwargs)
+            except RateLimitError as e:
+                if attempt == self.retries - 1:
+                    raise
+                # Respetar Retry-After si OpenAI lo envía
+                retry_after = e.response.headers.get("retry-after") if self.honor_retry_after else None
+                try:
+                    wait = float(retry_after)
+                except (TypeError, ValueError):
+                    wait = min(MAX_BACKOFF_SECONDS, 2 ** attempt) + random.random()
+                time.sleep(wait)
+
+    def complete_cached(self, **kwargs) -> str:
+        """Devuelve el contenido de la respuesta, reutilizando la de una ejecución previa
+
+        La clave es el hash de la request completa (modelo, mensajes y
+        parámetros): si el prompt cambia, se vuelve a llamar a la API.
+        """
+        cache_path = cache_path_for(kwargs)
+
+        if cache_path.exists():
+            return cache_path.read_text(encoding='utf-8')
+
+        content = self.create_completion(**kwargs).choices[0].message.content
+        if content is not None:
+            store_cached(cache_path, content)
+        return content
+
+
+class DocumentIndex:
+    """Chunks de la colección ChromaDB en memoria, con búsqueda coseno exacta"""
+
+    def __init__(self, vectorstore, embeddings, max_chars: int, top_k: int, batch_size: int):
+        self.embeddings = embeddings
+        self.top_k = top_k
+        self.batch_size = batch_size
+
+        # Solo lectura: embeddings normalizados en memoria, búsqueda exacta por producto punto
+        data = vectorstore.get(include=["embeddings", "documents"])
+        if not data["documents"]:
+            # Colección vacía: reshape(0, -1) no puede inferir la dimensión
+            self.doc_vectors = np.empty((0, 0), dtype=np.float32)
+        else:
+            self.doc_vectors = np.asarray(data["embeddings"], dtype=np.float32).reshape(len(data["documents"]), -1)
+            self.doc_vectors /= np.linalg.norm(self.doc_vectors, axis=1, keepdims=True)
+        self.doc_texts = [doc[:max_chars] for doc in data["documents"]]
+
+    def __len__(self) -> int:
+        return len(self.doc_texts)
+
+    def retrieve_contexts(self, questions: List[Dict]) -> List[str]:
+        """Recupera el contexto RAG de todas las preguntas con un solo batch de embeddings
+
+        Las consultas repetidas (mismo texto salvo mayúsculas/espacios) se
+        embeben y buscan una sola vez.
+        """
+        if not questions:
+            return []
+
+        queries = [f"{q['question']} {' '.join(q['options'].values())}" for q in questions]
+        keys = [' '.join(query.lower().split()) for query in queries]
+
+        unique = {}
+        for key, query in zip(keys, queries):
+            unique.setdefault(key, query)
+        texts = list(unique.values())
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+
+        # Batches concurrentes; ex.map conserva el orden de los vectores
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as ex:
+            vectors = [vector for batch in ex.map(self.embeddings.embed_documents, batches) for vector in batch]
+
+        contexts = self.search_by_vectors(vectors)
+        context_by_key = dict(zip(unique, contexts))
+        return [context_by_key[key] for key in keys]
+
+    def search_by_vectors(self, vectors: List[List[float]]) -> List[str]:
+        """Top-k chunks por similitud coseno para todas las queries (una matmul por batch)"""
+        k = min(self.top_k, len(self.doc_texts))
+        if k == 0:
+            return [""] * len(vectors)
+
+        query_vectors = np.asarray(vectors, dtype=np.float32)
+        query_vectors /= np.linalg.norm(query_vectors, axis=1, keepdims=True)
+
+        contexts = []
+        for start in range(0, len(query_vectors), self.batch_size):
+            scores = query_vectors[start:start + self.batch_size] @ self.doc_vectors.T
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            # Ordenar los k mejores de mayor a menor similitud
+            order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+            for row in np.take_along_axis(top, order, axis=1):
+                contexts.append("\n\n".join(self.doc_texts[i] for i in row))
+        return contexts
@@ -5,10 +5,13 @@ Descarga documentación oficial de AWS para usar en RAG
 """
 
 import os
+import shutil
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List, Dict
-import time
 
 # Directorios
 PROJECT_ROOT = Path(__file__).parent.parent
@@ -55,30 +58,53 @@ SERVICE_FAQS = {
     "cloudfront": "https://aws.amazon.com/cloudfront/faqs/",
 }
 
+# Descargas concurrentes
+MAX_WORKERS = 8
+
+# Sesión HTTP compartida (keep-alive + pool de conexiones + reintentos)
+_SESSION = requests.Session()
+_SESSION.headers['User-Agent'] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+_SESSION.mount('https://', HTTPAdapter(pool_maxsize=MAX_WORKERS,
+                                       max_retries=Retry(total=3, backoff_factor=0.5)))
+
 
 def download_file(url: str, output_path: Path, desc: str = "") -> bool:
     """Descarga un archivo desde URL"""
+    # Se descarga a .part y se renombra al terminar: un corte a mitad de la
+    # descarga no deja un archivo truncado que la próxima ejecución dé por bueno
+    part_path = output_path.with_suffix(output_path.suffix + ".part")
     try:
         print(f"📥 Descargando: {desc or url}")
 
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        }
+        # Stream a disco: memoria constante sin importar el tamaño del archivo
+        with _SESSION.get(url, timeout=30, stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True  # descomprimir gzip al vuelo
 
-        response = requests.get(url, headers=headers, timeout=30)
-        response.raise_for_status()
+            with open(part_path, 'wb') as f:
+                shutil.copyfileobj(response.raw, f, length=1 << 16)
 
-        with open(output_path, 'wb') as f:
-            f.write(response.content)
+        os.replace(part_path, output_path)
 
         print(f"   ✅ Guardado en: {output_path}")
         return True
 
     except Exception as e:
         print(f"   ❌ Error: {str(e)}")
+        part_path.unlink(missing_ok=True)
         return False
 
 
+def download_all(downloads: List[tuple]) -> int:
+    """Descarga (url, output_path, desc) en paralelo, retorna cuántas tuvieron éxito"""
+    if not downloads:
+        return 0
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        results = ex.map(lambda args: download_file(*args), downloads)
+        return sum(results)
+
+
 def fetch_aws_official_docs():
     """Descarga documentos oficiales AWS"""
     print("\n" + "="*60)
@@ -87,6 +113,7 @@ def fetch_aws_official_docs():
 
     success_count = 0
     total_count = len(AWS_DOCS_SOURCES)
+    pending = []
 
     for key, doc_info in AWS_DOCS_SOURCES.items():
         output_path = DOCS_DIR / doc_info["filename"]
@@ -96,10 +123,9 @@ def fetch_aws_official_docs():
             success_count += 1
             continue
 
-        if download_file(doc_info["url"], output_path, doc_info["filename"]):
-            success_count += 1
+        pending.append((doc_info["url"], output_path, doc_info["filename"]))
 
-        time.sleep(1)  # Rate limiting
+    success_count += download_all(pending)
 
     print(f"\n✨ Documentos oficiales: {success_count}/{total_count} descargados")
 
@@ -112,6 +138,7 @@ def fetch_service_faqs():
 
     success_count = 0
     total_count = len(SERVICE_FAQS)
+    pending = []
 
     for service, url in SERVICE_FAQS.items():
         output_path = DOCS_DIR / f"{service}_faq.html"
@@ -121,10 +148,9 @@ def fetch_service_faqs():
             success_count += 1
             continue
 
-        if download_file(url, output_path, f"{service.upper()} FAQ"):
-            success_count += 1
+        pending.append((url, output_path, f"{service.upper()} FAQ"))
 
-        time.sleep(1)  # Rate limiting
+    success_count += download_all(pending)
 
     print(f"\n✨ Service FAQs: {success_count}/{total_count} descargados")
 
@@ -6,9 +6,12 @@ Procesa documentos AWS y crea vector database con ChromaDB
 
 import os
 import sys
+import hashlib
+import pickle
 from pathlib import Path
 from typing import List, Dict
-import json
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import orjson
 
 # Agregar project root al path
 PROJECT_ROOT = Path(__file__).parent.parent
@@ -28,6 +31,10 @@ from langchain_community.document_loaders import PyPDFLoader, UnstructuredHTMLLo
 from langchain_openai import OpenAIEmbeddings
 from langchain_community.vectorstores import Chroma
 from langchain.schema import Document
+import chromadb
+from chromadb.config import Settings
+from chromadb.errors import ChromaError
+from chromadb.utils.batch_utils import create_batches
 from tqdm import tqdm
 import tiktoken
 
@@ -35,17 +42,70 @@ import tiktoken
 DOCS_DIR = PROJECT_ROOT / "data" / "aws_docs"
 CHROMA_DIR = PROJECT_ROOT / "data" / "chroma_db"
 CHROMA_DIR.mkdir(parents=True, exist_ok=True)
+CACHE_DIR = PROJECT_ROOT / "data" / ".cache"  # Documentos ya parseados
 
 # Configuración
 CHUNK_SIZE = 500  # tokens
 CHUNK_OVERLAP = 50
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+EMBEDDING_MAX_TOKENS = 250_000  # tokens por request de embeddings (límite OpenAI: 300k)
+EMBEDDING_BATCH_SIZE = EMBEDDING_MAX_TOKENS // CHUNK_SIZE  # inputs por request (límite OpenAI: 2048)
+EMBEDDING_WORKERS = 8  # requests de embeddings en paralelo
+
+# Índice HNSW: coseno (embeddings OpenAI normalizados), grafo más conectado y
+# search_ef >= PREFETCH_K del script 4 (20) para buen recall en top-k
+HNSW_METADATA = {"hnsw:space": "cosine", "hnsw:M": 32, "hnsw:search_ef": 32}
+
+
+# Encoding de tiktoken (cargarlo es costoso, se reutiliza)
+_ENC = tiktoken.get_encoding("cl100k_base")
 
 
 def count_tokens(text: str) -> int:
     """Cuenta tokens usando tiktoken"""
-    encoding = tiktoken.get_encoding("cl100k_base")
-    return len(encoding.encode(text))
+    return len(_ENC.encode(text))
+
+
+def _load_pdf(path: str) -> List[Document]:
+    return PyPDFLoader(path).load()
+
+
+def _load_html(path: str) -> List[Document]:
+    return UnstructuredHTMLLoader(path).load()
+
+
+def _load_cached(path: str, loader) -> List[Document]:
+    """Parsea un archivo, reutilizando el resultado si su contenido no cambió"""
+    key = hashlib.sha256(Path(path).read_bytes()).hexdigest()
+    cache_path = CACHE_DIR / f"{loader.__name__}_{key}.pkl"
+
+    if cache_path.exists():
+        return pickle.loads(cache_path.read_bytes())
+
+    docs = loader(path)
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    cache_path.write_bytes(pickle.dumps(docs))
+    return docs
+
+
+def _load_files(files: List[Path], loader, doc_type: str, desc: str) -> List[Document]:
+    """Parsea archivos en paralelo (un proceso por archivo, parsing es CPU-bound)"""
+    documents = []
+
+    with ProcessPoolExecutor() as ex:
+        futures = [(path, ex.submit(_load_cached, str(path), loader)) for path in files]
+
+        for path, future in tqdm(futures, desc=desc):
+            try:
+                docs = future.result()
+                for doc in docs:
+                    doc.metadata["source"] = path.name
+                    doc.metadata["type"] = doc_type
+                documents.extend(docs)
+            except Exception as e:
+                print(f"      ⚠️  Error en {path.name}: {str(e)}")
+
+    return documents
 
 
 def load_documents() -> List[Document]:
@@ -57,32 +117,12 @@ def load_documents() -> List[Document]:
     # Cargar PDFs
     pdf_files = list(DOCS_DIR.glob("*.pdf"))
     print(f"\n   📄 Procesando {len(pdf_files)} PDFs...")
-
-    for pdf_path in tqdm(pdf_files, desc="PDFs"):
-        try:
-            loader = PyPDFLoader(str(pdf_path))
-            docs = loader.load()
-            for doc in docs:
-                doc.metadata["source"] = pdf_path.name
-                doc.metadata["type"] = "pdf"
-            documents.extend(docs)
-        except Exception as e:
-            print(f"      ⚠️  Error en {pdf_path.name}: {str(e)}")
+    documents.extend(_load_files(pdf_files, _load_pdf, "pdf", "PDFs"))
 
     # Cargar HTMLs
     html_files = list(DOCS_DIR.glob("*.html"))
     print(f"\n   🌐 Procesando {len(html_files)} HTMLs...")
-
-    for html_path in tqdm(html_files, desc="HTMLs"):
-        try:
-            loader = UnstructuredHTMLLoader(str(html_path))
-            docs = loader.load()
-            for doc in docs:
-                doc.metadata["source"] = html_path.name
-                doc.metadata["type"] = "html"
-            documents.extend(docs)
-        except Exception as e:
-            print(f"      ⚠️  Error en {html_path.name}: {str(e)}")
+    documents.extend(_load_files(html_files, _load_html, "html", "HTMLs"))
 
     print(f"\n   ✅ Total documentos cargados: {len(documents)}")
     return documents
@@ -92,11 +132,11 @@ def split_documents(documents: List[Document]) -> List[Document]:
     """Divide documentos en chunks con overlap"""
     print("\n✂️  Dividiendo documentos en chunks...")
 
-    # Usar RecursiveCharacterTextSplitter con estimación de tokens
+    # Usar RecursiveCharacterTextSplitter midiendo tokens reales
     text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=CHUNK_SIZE * 4,  # Aproximación: 1 token ≈ 4 chars
-        chunk_overlap=CHUNK_OVERLAP * 4,
-        length_function=len,
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
+        length_function=count_tokens,
         separators=["\n\n", "\n", ". ", " ", ""]
     )
 
@@ -106,7 +146,8 @@ def split_documents(documents: List[Document]) -> List[Document]:
     chunks = [c for c in chunks if len(c.page_content.strip()) > 50]
 
     # Calcular estadísticas de tokens
-    total_tokens = sum(count_tokens(c.page_content) for c in chunks[:100])  # Muestra
+    sample = _ENC.encode_batch([c.page_content for c in chunks[:100]])  # Muestra
+    total_tokens = sum(len(tokens) for tokens in sample)
     avg_tokens = total_tokens / min(100, len(chunks))
 
     print(f"   📊 Chunks creados: {len(chunks)}")
@@ -115,33 +156,76 @@ def split_documents(documents: List[Document]) -> List[Document]:
     return chunks
 
 
+def embed_chunks(embeddings: OpenAIEmbeddings, chunks: List[Document]) -> List[List[float]]:
+    """Calcula embeddings en batches grandes, con requests concurrentes
+
+    Cada batch respeta tanto el máximo de inputs como el de tokens por request.
+    """
+    texts = [c.page_content for c in chunks]
+
+    batches = []
+    batch, batch_tokens = [], 0
+    for text, tokens in zip(texts, _ENC.encode_batch(texts)):
+        if batch and (len(batch) == EMBEDDING_BATCH_SIZE or batch_tokens + len(tokens) > EMBEDDING_MAX_TOKENS):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(text)
+        batch_tokens += len(tokens)
+    if batch:
+        batches.append(batch)
+    print(f"   Procesando {len(chunks)} chunks en {len(batches)} batches...")
+
+    # ex.map conserva el orden de los batches
+    with ThreadPoolExecutor(max_workers=EMBEDDING_WORKERS) as ex:
+        results = list(tqdm(ex.map(embeddings.embed_documents, batches),
+                            total=len(batches), desc="Embeddings"))
+
+    return [vector for batch in results for vector in batch]
+
+
 def create_vector_store(chunks: List[Document]):
     """Crea vector store con ChromaDB"""
     print("\n🔮 Creando vector database con ChromaDB...")
 
     # Inicializar embeddings
     print(f"   Usando modelo: {EMBEDDING_MODEL}")
-    embeddings = OpenAIEmbeddings(model=EMBEDDING_MODEL)
-
-    # Crear ChromaDB en batches (para evitar rate limits)
-    batch_size = 100
-    total_batches = (len(chunks) + batch_size - 1) // batch_size
+    embeddings = OpenAIEmbeddings(model=EMBEDDING_MODEL, chunk_size=EMBEDDING_BATCH_SIZE)
 
-    print(f"   Procesando {len(chunks)} chunks en {total_batches} batches...")
+    # Calcular todos los embeddings antes de insertar
+    vectors = embed_chunks(embeddings, chunks)
 
-    # Primer batch (crear DB)
-    first_batch = chunks[:batch_size]
-    vectorstore = Chroma.from_documents(
-        documents=first_batch,
-        embedding=embeddings,
-        persist_directory=str(CHROMA_DIR),
-        collection_name="aws_docs"
+    # Cliente nativo de ChromaDB: inserción masiva con embeddings precalculados
+    client = chromadb.PersistentClient(
+        path=str(CHROMA_DIR),
+        settings=Settings(anonymized_telemetry=False)
     )
 
-    # Resto de batches (agregar a DB existente)
-    for i in tqdm(range(batch_size, len(chunks), batch_size), desc="Batches"):
-        batch = chunks[i:i + batch_size]
-        vectorstore.add_documents(batch)
+    # Reconstruir desde cero: con IDs fijos, add() no sobrescribe chunks previos
+    # y la metadata HNSW solo se aplica al crear la colección
+    try:
+        client.delete_collection("aws_docs")
+    except (ValueError, ChromaError):
+        pass  # No existía
+    collection = client.create_collection("aws_docs", metadata=HNSW_METADATA)
+
+    # Un solo add (create_batches solo divide si se excede el máximo del backend)
+    # El ID también va en metadata para que las preguntas referencien el chunk
+    ids = [f"chunk_{i}" for i in range(len(chunks))]
+    for batch in create_batches(
+        api=client,
+        ids=ids,
+        embeddings=vectors,
+        metadatas=[{**c.metadata, "chunk_id": chunk_id} for c, chunk_id in zip(chunks, ids)],
+        documents=[c.page_content for c in chunks]
+    ):
+        collection.add(*batch)
+
+    # Wrapper de LangChain solo para consultas
+    vectorstore = Chroma(
+        client=client,
+        collection_name="aws_docs",
+        embedding_function=embeddings
+    )
 
     print(f"   ✅ Vector store creado en: {CHROMA_DIR}")
 
@@ -195,8 +279,8 @@ def save_metadata(chunks: List[Document]):
     }
 
     metadata_path = CHROMA_DIR / "metadata.json"
-    with open(metadata_path, 'w') as f:
-        json.dump(metadata, f, indent=2)
+    with open(metadata_path, 'wb') as f:
+        f.write(orjson.dumps(metadata, option=orjson.OPT_INDENT_2))
 
     print(f"\n📋 Metadata guardada en: {metadata_path}")
 
@@ -6,15 +6,25 @@ Calculadora interactiva de costos para generación de preguntas
 
 import os
 import sys
+from functools import lru_cache
 from pathlib import Path
-import tiktoken
+import orjson
 
 PROJECT_ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from pipeline_utils import PROMPT_CACHE_MIN_TOKENS, build_system_prompts, get_model_encoding, largest_remainder
+
+PROMPTS_DIR = PROJECT_ROOT / "prompts"
+
+# OpenAI cachea el prefijo del prompt en incrementos de 128 tokens
+PROMPT_CACHE_INCREMENT = 128
 
 # Precios OpenAI (2025)
 PRICES = {
     "gpt-4o-mini": {
         "input": 0.15 / 1_000_000,   # $0.15 per 1M tokens
+        "cached_input": 0.075 / 1_000_000,  # $0.075 per 1M tokens (prompt caching)
         "output": 0.60 / 1_000_000   # $0.60 per 1M tokens
     },
     "text-embedding-3-small": {
@@ -22,6 +32,23 @@ PRICES = {
     }
 }
 
+# Batch API de OpenAI (script 4 con --batch): 50% de descuento
+BATCH_DISCOUNT = 0.5
+
+# Si LiteLLM está instalado, usar su tabla de precios (se mantiene actualizada)
+try:
+    from litellm import model_cost
+
+    for _model, _prices in PRICES.items():
+        _costs = model_cost.get(_model, {})
+        for _key, _litellm_key in (("input", "input_cost_per_token"),
+                                   ("cached_input", "cache_read_input_token_cost"),
+                                   ("output", "output_cost_per_token")):
+            if _key in _prices and _costs.get(_litellm_key) is not None:
+                _prices[_key] = _costs[_litellm_key]
+except ImportError:
+    pass
+
 # Dominios oficiales CLF-C02
 DOMAINS = {
     "Domain 1: Cloud Concepts": 24,
@@ -31,10 +58,31 @@ DOMAINS = {
 }
 
 
+@lru_cache(maxsize=1)
+def _get_encoding():
+    """Carga el encoding de tiktoken una sola vez (parsear el BPE es costoso)"""
+    return get_model_encoding("gpt-4o-mini")
+
+
 def count_tokens(text: str) -> int:
     """Cuenta tokens usando tiktoken"""
-    encoding = tiktoken.get_encoding("cl100k_base")
-    return len(encoding.encode(text))
+    return len(_get_encoding().encode(text))
+
+
+@lru_cache(maxsize=1)
+def system_prompt_tokens_by_domain() -> dict:
+    """Tokens del system prompt por dominio, construido igual que en el script 4"""
+    system_prompt = (PROMPTS_DIR / "system.txt").read_text(encoding='utf-8')
+    examples = orjson.loads((PROMPTS_DIR / "examples.json").read_bytes())
+    prompts = build_system_prompts(system_prompt, examples, DOMAINS, count_tokens)
+    return {domain: count_tokens(prompt) for domain, prompt in prompts.items()}
+
+
+def cacheable_tokens(prefix_tokens: int) -> int:
+    """Tokens del prefijo que OpenAI sirve desde caché (0 si no llega al mínimo)"""
+    if prefix_tokens < PROMPT_CACHE_MIN_TOKENS:
+        return 0
+    return prefix_tokens - (prefix_tokens - PROMPT_CACHE_MIN_TOKENS) % PROMPT_CACHE_INCREMENT
 
 
 def estimate_generation_cost(num_questions: int):
@@ -42,11 +90,16 @@ def estimate_generation_cost(num_questions: int):
 
     # Estimaciones por pregunta
     context_tokens = 800  # Contexto RAG (3 chunks de ~250 tokens c/u)
-    system_prompt_tokens = 200  # System prompt
-    user_prompt_tokens = 100  # User prompt con instrucciones
-    examples_tokens = 300  # Few-shot examples
+    user_prompt_tokens = 40  # User prompt (topic + escenario; el formato lo fija el JSON schema)
 
-    input_per_question = context_tokens + system_prompt_tokens + user_prompt_tokens + examples_tokens
+    # System prompt + ejemplo: prefijo estable por dominio, medido sobre prompts/.
+    # Solo se cachea si llega a PROMPT_CACHE_MIN_TOKENS, y la primera request
+    # de cada dominio no encuentra caché
+    prefix_tokens = system_prompt_tokens_by_domain()
+    distribution = distribute_questions_by_domain(num_questions)
+    total_prefix = sum(count * prefix_tokens[domain] for domain, count in distribution.items())
+    total_cached = sum(max(count - 1, 0) * cacheable_tokens(prefix_tokens[domain])
+                       for domain, count in distribution.items())
 
     # Output esperado
     question_tokens = 50  # Pregunta
@@ -55,21 +108,24 @@ def estimate_generation_cost(num_questions: int):
     output_per_question = question_tokens + options_tokens + explanation_tokens
 
     # Totales
-    total_input = num_questions * input_per_question
+    total_input = num_questions * (context_tokens + user_prompt_tokens) + total_prefix
     total_output = num_questions * output_per_question
 
     # Costos
-    input_cost = total_input * PRICES["gpt-4o-mini"]["input"]
+    input_cost = ((total_input - total_cached) * PRICES["gpt-4o-mini"]["input"]
+                  + total_cached * PRICES["gpt-4o-mini"]["cached_input"])
     output_cost = total_output * PRICES["gpt-4o-mini"]["output"]
     generation_cost = input_cost + output_cost
 
     return {
         "num_questions": num_questions,
         "total_input_tokens": total_input,
+        "cached_input_tokens": total_cached,
         "total_output_tokens": total_output,
         "input_cost": input_cost,
         "output_cost": output_cost,
-        "generation_cost": generation_cost
+        "generation_cost": generation_cost,
+        "batch_generation_cost": generation_cost * BATCH_DISCOUNT
     }
 
 
@@ -104,19 +160,8 @@ def estimate_evaluation_cost(num_questions: int):
 
 def distribute_questions_by_domain(total_questions: int) -> dict:
     """Distribuye preguntas según porcentajes oficiales CLF-C02"""
-    distribution = {}
-    for domain, percentage in DOMAINS.items():
-        count = round((percentage / 100) * total_questions)
-        distribution[domain] = count
-
-    # Ajustar para que sume exactamente total_questions
-    diff = total_questions - sum(distribution.values())
-    if diff != 0:
-        # Agregar/quitar del dominio con mayor porcentaje
-        max_domain = max(DOMAINS, key=DOMAINS.get)
-        distribution[max_domain] += diff
-
-    return distribution
+    counts = largest_remainder(list(DOMAINS.values()), total_questions)
+    return dict(zip(DOMAINS, counts.tolist()))
 
 
 def print_cost_breakdown(generation, evaluation, buffer_pct=30):
@@ -128,11 +173,13 @@ def print_cost_breakdown(generation, evaluation, buffer_pct=30):
 
     print(f"\n📊 Generación de {generation['num_questions']} preguntas con RAG:")
     print(f"   Input tokens:  {generation['total_input_tokens']:,} tokens")
+    print(f"     (cacheados:  {generation['cached_input_tokens']:,} tokens)")
     print(f"   Output tokens: {generation['total_output_tokens']:,} tokens")
     print(f"   Costo input:   ${generation['input_cost']:.4f}")
     print(f"   Costo output:  ${generation['output_cost']:.4f}")
     print(f"   {'─'*66}")
     print(f"   Subtotal:      ${generation['generation_cost']:.4f}")
+    print(f"   (con --batch:  ${generation['batch_generation_cost']:.4f})")
 
     print(f"\n🔍 Phoenix Evaluations ({evaluation['total_evaluations']} evals):")
     print(f"   Input tokens:  {evaluation['total_input_tokens']:,} tokens")
@@ -6,11 +6,13 @@ Genera preguntas de examen AWS CLF-C02 usando GPT-4o-mini con RAG
 
 import os
 import sys
-import json
+import time
 import argparse
+import threading
 from pathlib import Path
 from typing import List, Dict
-import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 PROJECT_ROOT = Path(__file__).parent.parent
 sys.path.insert(0, str(PROJECT_ROOT))
@@ -18,18 +20,14 @@ sys.path.insert(0, str(PROJECT_ROOT))
 from dotenv import load_dotenv
 load_dotenv()
 
-# Verificar API key
-if not os.getenv("OPENAI_API_KEY"):
-    print("❌ Error: OPENAI_API_KEY no encontrada en .env")
-    sys.exit(1)
-
-from openai import OpenAI
-from langchain_openai import OpenAIEmbeddings
-from langchain_community.vectorstores import Chroma
+# openai, langchain, chromadb y tiktoken se importan al usarse (arranque rápido de --help)
 from tqdm import tqdm
-import tiktoken
-import random
-from difflib import SequenceMatcher
+import numpy as np
+import orjson
+from datasketch import MinHash, MinHashLSH
+
+from pipeline_utils import (MAX_CONCURRENT_REQUESTS, PROMPT_CACHE_MIN_TOKENS, RateLimitedClient,
+                            build_system_prompts, get_model_encoding, largest_remainder, load_checkpoint)
 
 # Configuración
 CHROMA_DIR = PROJECT_ROOT / "data" / "chroma_db"
@@ -38,6 +36,52 @@ OUTPUT_DIR = PROJECT_ROOT / "data"
 
 MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+# Precio por token de gpt-4o-mini (si LiteLLM está instalado se usa su tabla)
+INPUT_RATE = 0.15 / 1_000_000   # $0.15 per 1M tokens
+OUTPUT_RATE = 0.60 / 1_000_000  # $0.60 per 1M tokens
+
+DUPLICATE_THRESHOLD = 0.7  # Jaccard de shingles a partir del cual una pregunta es duplicada
+MINHASH_PERMUTATIONS = 128
+SHINGLE_SIZE = 3  # Caracteres por shingle
+
+MIN_PROGRESS_BAR = 10  # Batches de este tamaño o menos no muestran progress bar
+CONTEXT_TOKENS_PER_CHUNK = 260  # Presupuesto por chunk (~800 tokens de contexto con k=3)
+PREFETCH_K = 20  # Documentos precargados por query (se muestrean k por pregunta)
+
+# Esquema de salida (structured outputs strict: la respuesta siempre es JSON válido)
+QUESTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "question": {"type": "string"},
+        "options": {
+            "type": "object",
+            "properties": {letter: {"type": "string"} for letter in "ABCD"},
+            "required": list("ABCD"),
+            "additionalProperties": False
+        },
+        "correct_answer": {"type": "string", "enum": list("ABCD")},
+        "explanation": {"type": "string"}
+    },
+    "required": ["question", "options", "correct_answer", "explanation"],
+    "additionalProperties": False
+}
+
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "clf_question", "schema": QUESTION_SCHEMA, "strict": True}
+}
+
+# Parámetros de generación (compartidos por el modo síncrono y el Batch API)
+GENERATION_PARAMS = {
+    "temperature": 1.0,  # Máxima creatividad
+    "top_p": 0.9,  # Nucleus sampling
+    "response_format": RESPONSE_FORMAT
+}
+
+# Batch API de OpenAI: 50% más barato, resultados en hasta 24h
+BATCH_DISCOUNT = 0.5
+BATCH_POLL_SECONDS = 60
+BATCH_FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
 
 # Dominios CLF-C02
 DOMAINS = {
@@ -105,15 +149,35 @@ BUSINESS_SCENARIOS = [
 ]
 
 
+def load_model_rates() -> tuple:
+    """Retorna (input, output) en USD por token para MODEL"""
+    try:
+        from litellm import model_cost
+        return model_cost[MODEL]["input_cost_per_token"], model_cost[MODEL]["output_cost_per_token"]
+    except (ImportError, KeyError):
+        return INPUT_RATE, OUTPUT_RATE
+
+
 class QuestionGenerator:
-    def __init__(self):
+    def __init__(self, seed: int = None):
+        from openai import OpenAI
+        import tiktoken
+
         self.client = OpenAI()
-        self.vectorstore = None
+        self.llm = RateLimitedClient(self.client)
+        self.chroma_client = None  # Un solo cliente ChromaDB compartido por los threads
+        self.collection = None
+        self.embeddings = None
+        self.docs_by_query = {}  # Documentos RAG precargados por query
+        self.chunk_cache = {}  # chunk_id -> (fuente, texto recortado)
         self.system_prompt = None
         self.examples = None
-        self.encoding = tiktoken.get_encoding("cl100k_base")
+        self.system_by_domain = {}  # System prompt final por dominio
+        self.encoding = tiktoken.get_encoding("cl100k_base")  # Solo para recortar el contexto RAG
         self.generated_questions = []  # Para deduplicación
-        self.scenario_index = 0  # Rotar escenarios
+        self.lsh = MinHashLSH(threshold=DUPLICATE_THRESHOLD, num_perm=MINHASH_PERMUTATIONS)
+        self.dedup_lock = threading.Lock()  # MinHashLSH no es thread-safe
+        self.rng = np.random.default_rng(seed)  # Planificación reproducible con --seed
 
     def load_rag_system(self):
         """Carga el sistema RAG"""
@@ -124,12 +188,16 @@ class QuestionGenerator:
             print("   Ejecuta: python scripts/2_build_rag.py")
             sys.exit(1)
 
-        embeddings = OpenAIEmbeddings(model=EMBEDDING_MODEL)
-        self.vectorstore = Chroma(
-            persist_directory=str(CHROMA_DIR),
-            embedding_function=embeddings,
-            collection_name="aws_docs"
+        import chromadb
+        from chromadb.config import Settings
+        from langchain_openai import OpenAIEmbeddings
+
+        self.embeddings = OpenAIEmbeddings(model=EMBEDDING_MODEL)
+        self.chroma_client = chromadb.PersistentClient(
+            path=str(CHROMA_DIR),
+            settings=Settings(anonymized_telemetry=False)
         )
+        self.collection = self.chroma_client.get_collection("aws_docs")
         print("   ✅ RAG system cargado")
 
     def load_prompts(self):
@@ -143,124 +211,185 @@ class QuestionGenerator:
 
         # Examples
         examples_path = PROMPTS_DIR / "examples.json"
-        with open(examples_path, 'r', encoding='utf-8') as f:
-            self.examples = json.load(f)
-
-        print("   ✅ Prompts cargados")
-
-    def similarity_ratio(self, text1: str, text2: str) -> float:
-        """Calcula similaridad entre dos textos (0-1)"""
-        return SequenceMatcher(None, text1.lower(), text2.lower()).ratio()
-
-    def is_duplicate(self, new_question: str, threshold: float = 0.7) -> bool:
-        """Verifica si la pregunta es muy similar a una existente"""
-        for existing in self.generated_questions:
-            if self.similarity_ratio(new_question, existing) > threshold:
-                return True
-        return False
-
-    def get_next_scenario(self) -> str:
-        """Obtiene siguiente escenario de negocio (rotación)"""
-        scenario = BUSINESS_SCENARIOS[self.scenario_index % len(BUSINESS_SCENARIOS)]
-        self.scenario_index += 1
-        return scenario
-
-    def get_relevant_context(self, domain: str, topic: str, k: int = 3) -> str:
-        """Obtiene contexto relevante usando RAG con variación de query"""
+        self.examples = orjson.loads(examples_path.read_bytes())
+
+        # System prompt por dominio (instrucciones + ejemplo): idéntico para
+        # todas las preguntas del dominio, lo que aprovecha el prompt caching
+        encoding = get_model_encoding(MODEL)
+        count_tokens = lambda text: len(encoding.encode(text))
+        self.system_by_domain = build_system_prompts(self.system_prompt, self.examples, DOMAINS, count_tokens)
+
+        prefix_tokens = {domain: count_tokens(prompt) for domain, prompt in self.system_by_domain.items()}
+        short = [domain for domain, tokens in prefix_tokens.items() if tokens < PROMPT_CACHE_MIN_TOKENS]
+        if short:
+            print(f"   ⚠️ System prompt bajo {PROMPT_CACHE_MIN_TOKENS} tokens, sin prompt caching en: {', '.join(short)}")
+
+        print(f"   ✅ Prompts cargados (system prompt: {min(prefix_tokens.values())}-{max(prefix_tokens.values())} tokens)")
+
+    def minhash(self, text: str) -> MinHash:
+        """MinHash de los shingles de caracteres del texto"""
+        text = text.lower()
+        mh = MinHash(num_perm=MINHASH_PERMUTATIONS)
+        mh.update_batch([
+            text[i:i + SHINGLE_SIZE].encode('utf-8')
+            for i in range(max(len(text) - SHINGLE_SIZE + 1, 1))
+        ])
+        return mh
+
+    def check_and_add(self, new_question: str) -> bool:
+        """Registra la pregunta si no es muy similar a una existente (MinHash-LSH)
+
+        Consulta e inserción van bajo el mismo lock: dos hilos con preguntas
+        casi idénticas no pueden aceptarse ambos. Devuelve False si es duplicada.
+        """
+        mh = self.minhash(new_question)
+        with self.dedup_lock:
+            if self.lsh.query(mh):
+                return False
+            self.lsh.insert(str(len(self.generated_questions)), mh)
+            self.generated_questions.append(new_question)
+            return True
+
+    def add_generated(self, question: str):
+        """Registra una pregunta aceptada para la deduplicación (sin verificar duplicados)"""
+        mh = self.minhash(question)
+        with self.dedup_lock:
+            self.lsh.insert(str(len(self.generated_questions)), mh)
+            self.generated_questions.append(question)
+
+    def prefetch_contexts(self, distribution: List[tuple], k: int = PREFETCH_K):
+        """Precarga el contexto RAG de todas las queries posibles del batch
+
+        Las queries únicas (domain, topic, variación) se embeben en una sola
+        llamada a la API y se buscan en un solo `collection.query` batcheado,
+        en vez de un embedding y una búsqueda por pregunta.
+        """
+        queries = list(dict.fromkeys(
+            f"{domain}: {template.format(topic=topic)}"
+            for domain, topic, _ in distribution
+            for template in QUERY_VARIATIONS
+        ))
+        if not queries:
+            return
+
+        vectors = self.embeddings.embed_documents(queries)
+        self.docs_by_query.update(zip(queries, self.query_collection(vectors, k)))
+
+    def query_collection(self, vectors: List[List[float]], k: int) -> List[List[tuple]]:
+        """Busca los k chunks más cercanos de cada vector en una sola query
+
+        Retorna, por vector, una lista de (chunk_id, fuente, texto) ordenada
+        por relevancia. Cada chunk se recorta a CONTEXT_TOKENS_PER_CHUNK una
+        sola vez, aunque aparezca en varios pools.
+        """
+        result = self.collection.query(
+            query_embeddings=vectors,
+            n_results=k,
+            include=["documents", "metadatas"]
+        )
+
+        pools = []
+        for ids, documents, metadatas in zip(result["ids"], result["documents"], result["metadatas"]):
+            for chunk_id, document, metadata in zip(ids, documents, metadatas):
+                if chunk_id not in self.chunk_cache:
+                    self.chunk_cache[chunk_id] = (
+                        metadata.get('source', 'Unknown'),
+                        self.truncate_tokens(document, CONTEXT_TOKENS_PER_CHUNK)
+                    )
+            pools.append([(chunk_id, *self.chunk_cache[chunk_id]) for chunk_id in ids])
+        return pools
+
+    def spawn_rngs(self, n: int) -> List[np.random.Generator]:
+        """Un generador independiente por pregunta (los threads no comparten estado)"""
+        return [np.random.default_rng(seed) for seed in self.rng.integers(2**63, size=n).tolist()]
+
+    def get_relevant_context(self, domain: str, topic: str, rng: np.random.Generator, k: int = 3) -> tuple:
+        """Obtiene contexto relevante usando RAG con variación de query
+
+        Retorna (contexto, chunk_ids): el texto va al prompt y los IDs se
+        guardan con la pregunta para recuperar el contexto desde ChromaDB.
+        """
         # Variar query para obtener contexto diferente
-        query_template = random.choice(QUERY_VARIATIONS)
+        query_template = QUERY_VARIATIONS[rng.integers(len(QUERY_VARIATIONS))]
         query = query_template.format(topic=topic)
         full_query = f"{domain}: {query}"
 
-        docs = self.vectorstore.similarity_search(full_query, k=k)
+        pool = self.docs_by_query.get(full_query)
+        if pool is None:
+            # Query no precargada: buscar el pool completo y cachearlo
+            pool = self.query_collection([self.embeddings.embed_query(full_query)], PREFETCH_K)[0]
+            self.docs_by_query[full_query] = pool
+
+        # Muestrear k documentos del pool (manteniendo orden de relevancia)
+        # para que preguntas del mismo topic no compartan siempre el contexto
+        picked = np.sort(rng.choice(len(pool), size=min(k, len(pool)), replace=False))
+        docs = [pool[i] for i in picked.tolist()]
 
         context_parts = []
-        for i, doc in enumerate(docs, 1):
-            source = doc.metadata.get('source', 'Unknown')
-            content = doc.page_content[:500]  # Limitar tamaño
+        chunk_ids = []
+        for i, (chunk_id, source, content) in enumerate(docs, 1):
             context_parts.append(f"[Fuente {i}: {source}]\n{content}")
+            chunk_ids.append(chunk_id)
 
-        return "\n\n".join(context_parts)
-
-    def get_example_for_domain(self, domain: str) -> dict:
-        """Obtiene ejemplo few-shot para el dominio"""
-        for ex in self.examples:
-            if ex["domain"] == domain:
-                return ex["example"]
-        return self.examples[0]["example"]  # Fallback
+        return "\n\n".join(context_parts), chunk_ids
 
-    def count_tokens(self, text: str) -> int:
-        """Cuenta tokens"""
-        return len(self.encoding.encode(text))
+    def truncate_tokens(self, text: str, max_tokens: int) -> str:
+        """Recorta el texto a `max_tokens` tokens"""
+        tokens = self.encoding.encode(text)
+        if len(tokens) <= max_tokens:
+            return text
+        return self.encoding.decode(tokens[:max_tokens])
 
-    def generate_question(self, domain: str, topic: str, max_retries: int = 3) -> dict:
-        """Genera una pregunta usando RAG + GPT-4o-mini con deduplicación"""
+    def build_messages(self, domain: str, topic: str, scenario: str, context: str) -> List[dict]:
+        """Construye los mensajes: system estable por dominio + user variable al final"""
+        user_msg = f"""Genera UNA pregunta de examen sobre: {topic}
 
-        for attempt in range(max_retries):
-            # 1. Obtener contexto relevante (varía cada intento)
-            context = self.get_relevant_context(domain, topic)
+ESCENARIO: {scenario}. Usa SOLO información del contexto y varía la estructura de la pregunta.
 
-            # 2. Obtener ejemplo few-shot
-            example = self.get_example_for_domain(domain)
+CONTEXTO OFICIAL AWS:
+{context}"""
 
-            # 3. Obtener escenario de negocio para esta pregunta
-            scenario = self.get_next_scenario()
+        return [
+            {"role": "system", "content": self.system_by_domain[domain]},
+            {"role": "user", "content": user_msg}
+        ]
 
-            # 4. Construir system prompt
-            system_msg = self.system_prompt.replace("{context}", context).replace("{domain}", domain)
-
-            # 5. Construir user prompt con variación
-            user_msg = f"""Genera UNA pregunta de examen sobre: {topic}
+    def generate_question(self, domain: str, topic: str, scenario: str, rng: np.random.Generator,
+                          max_retries: int = 3) -> dict:
+        """Genera una pregunta usando RAG + GPT-4o-mini con deduplicación"""
 
-CONTEXTO ESPECÍFICO: Usa un escenario con una {scenario}
+        for attempt in range(max_retries):
+            # 1. Obtener contexto relevante (varía cada intento)
+            context, chunk_ids = self.get_relevant_context(domain, topic, rng)
 
-Sigue el formato del siguiente ejemplo:
+            # 2. Construir mensajes (system precalculado por dominio + user variable)
+            messages = self.build_messages(domain, topic, scenario, context)
 
-{json.dumps(example, indent=2, ensure_ascii=False)}
+            # 3. Llamar a GPT-4o-mini
+            try:
+                response = self.llm.create_completion(model=MODEL, messages=messages, **GENERATION_PARAMS)
 
-IMPORTANTE:
-- Usa SOLO información del contexto proporcionado
-- La pregunta DEBE estar basada en el escenario de: {scenario}
-- Las 4 opciones deben ser plausibles pero distintas
-- La explicación debe ser educativa y completa
-- VARÍA la estructura de la pregunta (comparación, troubleshooting, best practice, etc.)
-- NO repitas frases como "Una startup de tecnología..." si ya las usaste
-- Responde SOLO con JSON válido, sin texto adicional"""
+                # 4. Parsear respuesta (el esquema garantiza JSON válido salvo rechazo)
+                message = response.choices[0].message
+                if message.refusal:
+                    raise ValueError(f"Modelo rechazó la solicitud: {message.refusal}")
+                question_data = orjson.loads(message.content)
 
-            # 6. Llamar a GPT-4o-mini
-            try:
-                response = self.client.chat.completions.create(
-                    model=MODEL,
-                    messages=[
-                        {"role": "system", "content": system_msg},
-                        {"role": "user", "content": user_msg}
-                    ],
-                    temperature=1.0,  # Máxima creatividad
-                    top_p=0.9,  # Nucleus sampling
-                    response_format={"type": "json_object"}
-                )
-
-                # 7. Parsear respuesta
-                content = response.choices[0].message.content
-                question_data = json.loads(content)
-
-                # 8. Verificar duplicación
+                # 5-6. Verificar duplicación y agregar a lista de generadas (atómico)
                 new_question_text = question_data.get("question", "")
-                if self.is_duplicate(new_question_text):
+                if not self.check_and_add(new_question_text):
                     if attempt < max_retries - 1:
-                        print(f"   ⚠️ Pregunta duplicada detectada, reintentando ({attempt + 1}/{max_retries})...")
+                        tqdm.write(f"   ⚠️ Pregunta duplicada detectada, reintentando ({attempt + 1}/{max_retries})...")
                         continue
                     else:
-                        print(f"   ⚠️ Pregunta duplicada después de {max_retries} intentos, aceptando...")
+                        tqdm.write(f"   ⚠️ Pregunta duplicada después de {max_retries} intentos, aceptando...")
+                        self.add_generated(new_question_text)
 
-                # 9. Agregar a lista de generadas
-                self.generated_questions.append(new_question_text)
-
-                # 10. Agregar metadata
+                # 7. Agregar metadata
                 question_data["domain"] = domain
                 question_data["topic"] = topic
                 question_data["scenario"] = scenario
-                question_data["retrieved_context"] = context[:500]  # Guardar para evals
+                question_data["context_chunk_ids"] = chunk_ids  # El evaluador recupera el texto de ChromaDB
                 question_data["tokens_used"] = {
                     "input": response.usage.prompt_tokens,
                     "output": response.usage.completion_tokens,
@@ -271,102 +400,275 @@ IMPORTANTE:
 
             except Exception as e:
                 if attempt < max_retries - 1:
-                    print(f"   ❌ Error en intento {attempt + 1}, reintentando...")
+                    tqdm.write(f"   ❌ Error en intento {attempt + 1}, reintentando...")
                     continue
                 else:
-                    print(f"\n❌ Error generando pregunta después de {max_retries} intentos: {str(e)}")
+                    tqdm.write(f"❌ Error generando pregunta después de {max_retries} intentos: {str(e)}")
                     return None
 
         return None
 
     def distribute_questions(self, total: int) -> List[tuple]:
-        """Distribuye preguntas por dominio y topic con aleatorización"""
-        distribution = []
+        """Distribuye preguntas por dominio y topic con aleatorización
+
+        Retorna tuplas (domain, topic, scenario). Los escenarios se asignan
+        en rotación sobre el orden final, así preguntas consecutivas nunca
+        comparten escenario y todos se usan por igual.
+        """
+        domains = []
+        topics = []
+        domain_counts = largest_remainder(list(DOMAINS.values()), total)
+
+        for domain, count in zip(DOMAINS, domain_counts.tolist()):
+            # Distribuir entre topics (los primeros reciben el sobrante)
+            topic_counts = largest_remainder(np.ones(len(DOMAIN_TOPICS[domain])), count)
+            domains.extend([domain] * count)
+            topics.extend(np.repeat(DOMAIN_TOPICS[domain], topic_counts).tolist())
+
+        # Aleatorizar orden para evitar patrones predecibles (una sola permutación)
+        order = self.rng.permutation(len(domains)).tolist()
+        return [
+            (domains[i], topics[i], BUSINESS_SCENARIOS[n % len(BUSINESS_SCENARIOS)])
+            for n, i in enumerate(order)
+        ]
+
+    def generate_batch(self, count: int, output_file: str = "questions_raw.json", resume: bool = False,
+                       concurrency: int = MAX_CONCURRENT_REQUESTS):
+        """Genera un batch de preguntas
+
+        Cada pregunta se escribe al JSONL en cuanto termina (memoria constante,
+        y un fallo no pierde lo ya generado); al final se convierte al JSON
+        que consumen los siguientes scripts.
+        """
 
-        for domain, percentage in DOMAINS.items():
-            count = round((percentage / 100) * total)
-            topics = DOMAIN_TOPICS[domain]
+        print(f"\n🚀 Generando {count} preguntas con RAG + GPT-4o-mini")
+        print(f"   Modelo: {MODEL}")
+        print("="*70)
 
-            # Distribuir entre topics
-            questions_per_topic = count // len(topics)
-            remainder = count % len(topics)
+        output_path = OUTPUT_DIR / output_file
+        jsonl_path = output_path.with_suffix(".jsonl")
 
-            for i, topic in enumerate(topics):
-                topic_count = questions_per_topic
-                if i < remainder:
-                    topic_count += 1
+        # Distribuir preguntas
+        distribution = self.distribute_questions(count)
 
-                for _ in range(topic_count):
-                    distribution.append((domain, topic))
+        # Reanudar: saltar los (domain, topic) ya generados en el JSONL
+        if resume:
+            previous = load_checkpoint(jsonl_path)
+            done = Counter((q["domain"], q["topic"]) for q in previous)
+            for q in previous:
+                self.add_generated(q.get("question", ""))
+
+            pending = []
+            for item in distribution:
+                if done[item[:2]] > 0:
+                    done[item[:2]] -= 1
+                else:
+                    pending.append(item)
+            distribution = pending
+            print(f"   ♻️  Reanudando: {len(previous)} preguntas previas, {len(distribution)} pendientes")
 
-        # Aleatorizar orden para evitar patrones predecibles
-        random.shuffle(distribution)
-        return distribution
+        # Precargar contexto RAG (un solo request de embeddings)
+        self.prefetch_contexts(distribution)
 
-    def generate_batch(self, count: int, output_file: str = "questions_raw.json"):
-        """Genera un batch de preguntas"""
+        generated_count = 0
+        total_cost = 0.0
+        failed_count = 0
+        input_rate, output_rate = load_model_rates()
+
+        # Generar en paralelo (I/O-bound), con progress bar
+        with open(jsonl_path, 'ab' if resume else 'wb') as out, \
+                ThreadPoolExecutor(max_workers=concurrency) as ex:
+            futures = [ex.submit(self.generate_question, domain, topic, scenario, rng)
+                       for (domain, topic, scenario), rng in zip(distribution, self.spawn_rngs(len(distribution)))]
+
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Generando",
+                                mininterval=0.5, disable=len(futures) <= MIN_PROGRESS_BAR):
+                question = future.result()
+
+                if question:
+                    out.write(orjson.dumps(question) + b"\n")
+                    out.flush()
+                    generated_count += 1
+
+                    # Calcular costo
+                    tokens = question["tokens_used"]
+                    total_cost += tokens["input"] * input_rate + tokens["output"] * output_rate
+                else:
+                    failed_count += 1
 
-        print(f"\n🚀 Generando {count} preguntas con RAG + GPT-4o-mini")
+        questions = self.save_output(jsonl_path, output_path)
+        self.print_summary(generated_count, failed_count, total_cost, output_path,
+                           total_in_file=len(questions) if resume else None)
+
+        return questions
+
+    def generate_batch_api(self, count: int, output_file: str = "questions_raw.json"):
+        """Genera un batch de preguntas con el Batch API de OpenAI (50% más barato)
+
+        Todas las requests se suben en un JSONL, se espera a que el batch
+        termine y se descargan los resultados. Sin reintentos posibles, las
+        preguntas duplicadas se descartan.
+        """
+
+        print(f"\n🚀 Generando {count} preguntas con RAG + Batch API")
         print(f"   Modelo: {MODEL}")
         print("="*70)
 
-        # Distribuir preguntas
-        distribution = self.distribute_questions(count)
+        output_path = OUTPUT_DIR / output_file
+        jsonl_path = output_path.with_suffix(".jsonl")
+        batch_input_path = output_path.with_name(f"{output_path.stem}_batch_input.jsonl")
 
-        questions = []
+        distribution = self.distribute_questions(count)
+        self.prefetch_contexts(distribution)
+
+        # 1. Escribir una request por pregunta (metadata guardada por custom_id)
+        metadata = {}
+        with open(batch_input_path, 'wb') as f:
+            for i, (domain, topic, scenario) in enumerate(distribution):
+                context, chunk_ids = self.get_relevant_context(domain, topic, self.rng)
+                metadata[str(i)] = {
+                    "domain": domain,
+                    "topic": topic,
+                    "scenario": scenario,
+                    "context_chunk_ids": chunk_ids
+                }
+                request = {
+                    "custom_id": str(i),
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": MODEL,
+                        "messages": self.build_messages(domain, topic, scenario, context),
+                        **GENERATION_PARAMS
+                    }
+                }
+                f.write(orjson.dumps(request) + b"\n")
+
+        # 2. Subir archivo y crear batch
+        with open(batch_input_path, 'rb') as f:
+            batch_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        print(f"   📤 Batch enviado: {batch.id}")
+
+        # 3. Esperar a que termine
+        while batch.status not in BATCH_FINAL_STATUSES:
+            time.sleep(BATCH_POLL_SECONDS)
+            batch = self.client.batches.retrieve(batch.id)
+            counts = batch.request_counts
+            if counts:
+                print(f"   ⏳ {batch.status}: {counts.completed}/{counts.total} completadas")
+
+        if batch.status != "completed" or not batch.output_file_id:
+            print(f"❌ Batch {batch.id} terminó con estado: {batch.status}")
+            return []
+
+        # 4. Descargar resultados y escribir cada pregunta al JSONL
+        generated_count = 0
+        failed_count = len(distribution)
+        duplicate_count = 0
         total_cost = 0.0
-        failed_count = 0
+        input_rate, output_rate = load_model_rates()
 
-        # Generar con progress bar
-        for i, (domain, topic) in enumerate(tqdm(distribution, desc="Generando"), 1):
-            question = self.generate_question(domain, topic)
+        results = self.client.files.content(batch.output_file_id)
+        with open(jsonl_path, 'wb') as out:
+            for line in results.iter_lines():
+                if not line.strip():
+                    continue
+                result = orjson.loads(line)
+                response = result.get("response") or {}
+                if result.get("error") or response.get("status_code") != 200:
+                    continue
 
-            if question:
-                questions.append(question)
+                body = response["body"]
+                message = body["choices"][0]["message"]
+                if message.get("refusal"):
+                    continue
+                try:
+                    question_data = orjson.loads(message["content"])
+                except (TypeError, orjson.JSONDecodeError):
+                    continue
 
-                # Calcular costo
-                input_cost = (question["tokens_used"]["input"] / 1_000_000) * 0.15
-                output_cost = (question["tokens_used"]["output"] / 1_000_000) * 0.60
-                total_cost += input_cost + output_cost
-            else:
-                failed_count += 1
+                usage = body["usage"]
+                total_cost += (usage["prompt_tokens"] * input_rate
+                               + usage["completion_tokens"] * output_rate) * BATCH_DISCOUNT
 
-            # Rate limiting (evitar rate limits de OpenAI)
-            if i % 10 == 0:
-                time.sleep(1)
+                # Misma deduplicación que el modo síncrono (sin reintento: se descarta)
+                new_question_text = question_data.get("question", "")
+                if not self.check_and_add(new_question_text):
+                    duplicate_count += 1
+                    continue
 
-        # Guardar preguntas
-        output_path = OUTPUT_DIR / output_file
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(questions, f, indent=2, ensure_ascii=False)
+                question_data.update(metadata[result["custom_id"]])
+                question_data["tokens_used"] = {
+                    "input": usage["prompt_tokens"],
+                    "output": usage["completion_tokens"],
+                    "total": usage["total_tokens"]
+                }
+                out.write(orjson.dumps(question_data) + b"\n")
+
+                generated_count += 1
+                failed_count -= 1
+
+        if duplicate_count:
+            print(f"   ⚠️ {duplicate_count} preguntas duplicadas descartadas")
 
-        # Resumen
+        questions = self.save_output(jsonl_path, output_path)
+        self.print_summary(generated_count, failed_count, total_cost, output_path)
+
+        return questions
+
+    def save_output(self, jsonl_path: Path, output_path: Path) -> List[dict]:
+        """Convierte el JSONL a JSON (formato que consumen los siguientes scripts)"""
+        questions = load_checkpoint(jsonl_path)
+        output_path.write_bytes(orjson.dumps(questions, option=orjson.OPT_INDENT_2))
+        return questions
+
+    def print_summary(self, generated: int, failed: int, total_cost: float, output_path: Path,
+                      total_in_file: int = None):
+        """Imprime resumen de la generación"""
         print("\n" + "="*70)
         print("✅ GENERACIÓN COMPLETADA")
         print("="*70)
-        print(f"Preguntas generadas: {len(questions)}")
-        print(f"Preguntas fallidas: {failed_count}")
+        print(f"Preguntas generadas: {generated}")
+        if total_in_file is not None:
+            print(f"Total en archivo: {total_in_file}")
+        print(f"Preguntas fallidas: {failed}")
         print(f"Costo total: ${total_cost:.4f} USD")
         print(f"Guardado en: {output_path}")
         print("\n📋 Siguiente paso:")
-        print(f"   python scripts/5_evaluate_with_phoenix.py --input {output_file}")
-
-        return questions
+        print(f"   python scripts/5_evaluate_with_phoenix.py --input {output_path.name}")
 
 
 def main():
     parser = argparse.ArgumentParser(description="Genera preguntas AWS CLF-C02 con RAG")
     parser.add_argument("--count", type=int, default=50, help="Número de preguntas a generar")
     parser.add_argument("--output", type=str, default="questions_raw.json", help="Archivo de salida")
+    parser.add_argument("--resume", action="store_true", help="Continuar desde el JSONL de una ejecución interrumpida")
+    parser.add_argument("--concurrency", type=int, default=MAX_CONCURRENT_REQUESTS, help="Requests a OpenAI en paralelo")
+    parser.add_argument("--seed", type=int, default=None, help="Semilla para una planificación reproducible")
+    parser.add_argument("--batch", action="store_true", help="Usar el Batch API de OpenAI (50%% más barato, hasta 24h)")
     args = parser.parse_args()
 
+    # Verificar API key
+    if not os.getenv("OPENAI_API_KEY"):
+        print("❌ Error: OPENAI_API_KEY no encontrada en .env")
+        sys.exit(1)
+
     # Inicializar generador
-    generator = QuestionGenerator()
+    generator = QuestionGenerator(seed=args.seed)
     generator.load_rag_system()
     generator.load_prompts()
 
     # Generar preguntas
-    questions = generator.generate_batch(args.count, args.output)
+    if args.batch:
+        questions = generator.generate_batch_api(args.count, args.output)
+    else:
+        questions = generator.generate_batch(args.count, args.output, resume=args.resume,
+                                             concurrency=args.concurrency)
 
     # Mostrar preview de primera pregunta
     if questions:
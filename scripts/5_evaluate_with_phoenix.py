@@ -6,11 +6,11 @@ Evalúa calidad de preguntas generadas usando Arize Phoenix
 
 import os
 import sys
-import json
 import argparse
 from pathlib import Path
 from typing import List, Dict
 import pandas as pd
+import orjson
 
 PROJECT_ROOT = Path(__file__).parent.parent
 sys.path.insert(0, str(PROJECT_ROOT))
@@ -24,133 +24,157 @@ if not os.getenv("OPENAI_API_KEY"):
 
 import phoenix as px
 from phoenix.evals import (
-    HallucinationEvaluator,
-    QAEvaluator,
+    HALLUCINATION_PROMPT_TEMPLATE,
+    QA_PROMPT_TEMPLATE,
     llm_classify,
     OpenAIModel
 )
-from tqdm import tqdm
+import chromadb
+from chromadb.config import Settings
+import tiktoken
 
 # Directorios
 DATA_DIR = PROJECT_ROOT / "data"
 PHOENIX_DIR = DATA_DIR / "phoenix_logs"
+CHROMA_DIR = DATA_DIR / "chroma_db"
 PHOENIX_DIR.mkdir(parents=True, exist_ok=True)
 
 # Configuración
 MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+CONTEXT_TOKENS_PER_CHUNK = 260  # Mismo presupuesto por chunk que el script 4
+EVAL_CONCURRENCY = 20  # Llamadas al juez LLM en paralelo (llm_classify)
+
+# Score por label de cada eval (labels no parseables cuentan como 0.5)
+HALLUCINATION_SCORES = {"hallucinated": 1.0, "factual": 0.0}
+QA_SCORES = {"correct": 1.0, "incorrect": 0.0}
+
+
+def load_contexts(questions: List[dict]) -> List[str]:
+    """Obtiene el contexto RAG de cada pregunta
+
+    Las preguntas del script 4 solo guardan `context_chunk_ids`; sus textos se
+    recuperan con un único `get` a ChromaDB. Las que ya traen
+    `retrieved_context` (scripts 6/6b) lo usan tal cual.
+    """
+    ids = list(dict.fromkeys(
+        chunk_id
+        for q in questions if "retrieved_context" not in q
+        for chunk_id in q.get("context_chunk_ids") or []
+        if chunk_id
+    ))
+
+    chunks = {}
+    if ids:
+        client = chromadb.PersistentClient(
+            path=str(CHROMA_DIR),
+            settings=Settings(anonymized_telemetry=False)
+        )
+        result = client.get_collection("aws_docs").get(ids=ids, include=["documents", "metadatas"])
+        encoding = tiktoken.get_encoding("cl100k_base")
+        for chunk_id, document, metadata in zip(result["ids"], result["documents"], result["metadatas"]):
+            content = encoding.decode(encoding.encode(document)[:CONTEXT_TOKENS_PER_CHUNK])
+            chunks[chunk_id] = (metadata.get("source", "Unknown"), content)
+
+    contexts = []
+    for q in questions:
+        if "retrieved_context" in q:
+            contexts.append(q["retrieved_context"])
+            continue
+        found = [chunks[c] for c in q.get("context_chunk_ids") or [] if c in chunks]
+        contexts.append("\n\n".join(
+            f"[Fuente {i}: {source}]\n{content}" for i, (source, content) in enumerate(found, 1)
+        ))
+    return contexts
 
 
 class QuestionEvaluator:
     def __init__(self, model_name: str = MODEL):
         self.model = OpenAIModel(model=model_name)
-        self.hallucination_eval = None
-        self.qa_eval = None
-
-    def setup_evaluators(self):
-        """Configura los evaluators de Phoenix"""
-        print("🔧 Configurando Phoenix Evaluators...")
-
-        # Hallucination Evaluator
-        self.hallucination_eval = HallucinationEvaluator(self.model)
-
-        # QA Evaluator
-        self.qa_eval = QAEvaluator(self.model)
-
-        print("   ✅ Evaluators configurados")
+        self.skipped_evals_count = 0  # Preguntas no compliant (sin evals LLM)
 
-    def evaluate_hallucination(self, question_data: dict) -> dict:
-        """Evalúa si la pregunta contiene hallucinations"""
+    def hallucination_record(self, question_data: dict, context_text: str) -> dict:
+        """Fila para el eval de hallucination: pregunta, explicación y contexto AWS"""
 
         # Input: pregunta + opciones
         input_text = f"{question_data['question']}\n\n"
         for letter, text in question_data['options'].items():
             input_text += f"{letter}) {text}\n"
 
-        # Output: explicación
-        output_text = question_data['explanation']
-
-        # Context: documentación AWS recuperada
-        context_text = question_data.get('retrieved_context', '')
-
-        try:
-            result = self.hallucination_eval.evaluate(
-                input=input_text,
-                output=output_text,
-                context=context_text
-            )
-
-            return {
-                "score": result.score,
-                "label": result.label,
-                "explanation": result.explanation
-            }
-        except Exception as e:
-            print(f"⚠️  Error en hallucination eval: {str(e)}")
-            return {"score": 0.5, "label": "unknown", "explanation": str(e)}
-
-    def evaluate_qa_correctness(self, question_data: dict) -> dict:
-        """Evalúa si la pregunta tiene sentido y la respuesta es correcta"""
-
-        # Input: pregunta
-        input_text = question_data['question']
-
-        # Output: respuesta correcta
-        correct_letter = question_data['correct_answer']
-        output_text = f"{correct_letter}) {question_data['options'][correct_letter]}"
-
-        # Reference: explicación
-        reference_text = question_data['explanation']
-
-        try:
-            result = self.qa_eval.evaluate(
-                input=input_text,
-                output=output_text,
-                reference=reference_text
-            )
-
-            return {
-                "score": result.score,
-                "label": result.label,
-                "explanation": result.explanation
-            }
-        except Exception as e:
-            print(f"⚠️  Error en QA eval: {str(e)}")
-            return {"score": 0.5, "label": "unknown", "explanation": str(e)}
-
-    def evaluate_clf_compliance(self, question_data: dict) -> dict:
-        """Evalúa compliance con formato CLF-C02"""
-
-        checks = {
-            "has_4_options": len(question_data.get('options', {})) == 4,
-            "has_correct_answer": question_data.get('correct_answer') in ['A', 'B', 'C', 'D'],
-            "has_domain": question_data.get('domain', '').startswith('Domain'),
-            "has_explanation": len(question_data.get('explanation', '')) > 100,
-            "answer_in_options": question_data.get('correct_answer') in question_data.get('options', {}),
-            "question_not_empty": len(question_data.get('question', '')) > 20
+        return {
+            "input": input_text,
+            "output": question_data['explanation'],  # Output: explicación
+            "reference": context_text  # Reference: documentación AWS recuperada
         }
 
-        score = sum(checks.values()) / len(checks)
-        passed = score >= 0.9  # 90% de checks deben pasar
-
-        failed_checks = [k for k, v in checks.items() if not v]
+    def qa_record(self, question_data: dict) -> dict:
+        """Fila para el eval de QA: pregunta, respuesta correcta y explicación"""
+        correct_letter = question_data.get('correct_answer', '')
+        correct_text = question_data.get('options', {}).get(correct_letter, '')
 
         return {
-            "score": score,
-            "label": "compliant" if passed else "non_compliant",
-            "explanation": f"Passed {sum(checks.values())}/{len(checks)} checks. Failed: {failed_checks}"
+            "input": question_data['question'],
+            "output": f"{correct_letter}) {correct_text}",
+            "reference": question_data['explanation']
         }
 
-    def evaluate_question(self, question_data: dict, index: int) -> dict:
-        """Evalúa una pregunta con todos los evaluators"""
-
-        # Eval 1: Hallucination
-        hall_result = self.evaluate_hallucination(question_data)
-
-        # Eval 2: QA Correctness
-        qa_result = self.evaluate_qa_correctness(question_data)
+    def classify(self, records: List[dict], template, scores: Dict[str, float]) -> List[dict]:
+        """Evalúa todas las filas con llm_classify (llamadas concurrentes)"""
+        try:
+            results = llm_classify(
+                dataframe=pd.DataFrame(records),
+                model=self.model,
+                template=template,
+                rails=list(scores),
+                provide_explanation=True,
+                concurrency=EVAL_CONCURRENCY
+            )
+        except Exception as e:
+            print(f"⚠️  Error en llm_classify: {str(e)}")
+            return [{"score": 0.5, "label": "unknown", "explanation": str(e)} for _ in records]
+
+        return [
+            {
+                "score": scores.get(label, 0.5),
+                "label": label if label in scores else "unknown",
+                "explanation": explanation if isinstance(explanation, str) else ""
+            }
+            for label, explanation in zip(results["label"], results["explanation"])
+        ]
+
+    def evaluate_clf_compliance(self, questions: List[dict]) -> List[dict]:
+        """Evalúa compliance con formato CLF-C02 (todas las preguntas a la vez)"""
+
+        df = pd.DataFrame({
+            "options": [q.get('options', {}) for q in questions],
+            "correct_answer": [q.get('correct_answer') for q in questions],
+            "domain": [q.get('domain', '') for q in questions],
+            "explanation": [q.get('explanation', '') for q in questions],
+            "question": [q.get('question', '') for q in questions]
+        })
+
+        checks = pd.DataFrame({
+            "has_4_options": df["options"].map(len) == 4,
+            "has_correct_answer": df["correct_answer"].isin(['A', 'B', 'C', 'D']),
+            "has_domain": df["domain"].str.startswith('Domain'),
+            "has_explanation": df["explanation"].str.len() > 100,
+            "answer_in_options": [answer in options for answer, options in zip(df["correct_answer"], df["options"])],
+            "question_not_empty": df["question"].str.len() > 20
+        })
+
+        passed_counts = checks.sum(axis=1)
+        scores = passed_counts / len(checks.columns)
+
+        return [
+            {
+                "score": score,
+                "label": "compliant" if score >= 0.9 else "non_compliant",  # 90% de checks deben pasar
+                "explanation": f"Passed {passed}/{len(checks.columns)} checks. Failed: {list(checks.columns[~row])}"
+            }
+            for score, passed, row in zip(scores.tolist(), passed_counts.tolist(), checks.to_numpy())
+        ]
 
-        # Eval 3: CLF-C02 Compliance
-        compliance_result = self.evaluate_clf_compliance(question_data)
+    def evaluate_question(self, index: int, hall_result: dict, qa_result: dict, compliance_result: dict) -> dict:
+        """Combina los tres evals de una pregunta"""
 
         # Combinar resultados
         eval_results = {
@@ -171,7 +195,7 @@ class QuestionEvaluator:
 
         return eval_results
 
-    def evaluate_batch(self, questions: List[dict]) -> tuple:
+    def evaluate_batch(self, questions: List[dict], contexts: List[str]) -> tuple:
         """Evalúa un batch de preguntas"""
 
         print(f"\n🔍 Evaluando {len(questions)} preguntas con Phoenix...")
@@ -181,8 +205,36 @@ class QuestionEvaluator:
         rejected_questions = []
         all_eval_results = []
 
-        for i, question in enumerate(tqdm(questions, desc="Evaluando"), 1):
-            eval_results = self.evaluate_question(question, i)
+        # Eval 3 primero: CLF-C02 Compliance (local, vectorizado). Las preguntas
+        # que no cumplen se rechazan sin gastar llamadas al juez LLM
+        compliance_results = self.evaluate_clf_compliance(questions)
+        to_judge = [i for i, r in enumerate(compliance_results) if r["score"] >= 0.9]
+        self.skipped_evals_count = len(questions) - len(to_judge)
+
+        skipped = "Omitido: la pregunta no cumple el formato CLF-C02"
+        hall_results = [{"score": 1.0, "label": "skipped", "explanation": skipped} for _ in questions]
+        qa_results = [{"score": 0.0, "label": "skipped", "explanation": skipped} for _ in questions]
+
+        if to_judge:
+            # Eval 1: Hallucination (contra la documentación AWS recuperada)
+            judged_hall = self.classify(
+                [self.hallucination_record(questions[i], contexts[i]) for i in to_judge],
+                HALLUCINATION_PROMPT_TEMPLATE, HALLUCINATION_SCORES
+            )
+
+            # Eval 2: QA Correctness
+            judged_qa = self.classify(
+                [self.qa_record(questions[i]) for i in to_judge],
+                QA_PROMPT_TEMPLATE, QA_SCORES
+            )
+
+            for i, hall_result, qa_result in zip(to_judge, judged_hall, judged_qa):
+                hall_results[i] = hall_result
+                qa_results[i] = qa_result
+
+        for i, (question, hall_result, qa_result, compliance_result) in enumerate(
+                zip(questions, hall_results, qa_results, compliance_results), 1):
+            eval_results = self.evaluate_question(i, hall_result, qa_result, compliance_result)
             all_eval_results.append(eval_results)
 
             # Agregar eval results a question data
@@ -193,9 +245,10 @@ class QuestionEvaluator:
             else:
                 # Agregar razón de rechazo
                 reasons = []
-                if eval_results["hallucination"]["score"] >= 0.3:
+                judged = eval_results["hallucination"]["label"] != "skipped"
+                if judged and eval_results["hallucination"]["score"] >= 0.3:
                     reasons.append(f"Hallucination: {eval_results['hallucination']['score']:.2f}")
-                if eval_results["qa_correctness"]["score"] <= 0.7:
+                if judged and eval_results["qa_correctness"]["score"] <= 0.7:
                     reasons.append(f"QA: {eval_results['qa_correctness']['score']:.2f}")
                 if eval_results["clf_compliance"]["score"] < 0.9:
                     reasons.append(f"Compliance: {eval_results['clf_compliance']['score']:.2f}")
@@ -220,10 +273,18 @@ class QuestionEvaluator:
         print(f"✅ Aprobadas: {approved} ({approval_rate:.1f}%)")
         print(f"❌ Rechazadas: {rejected} ({100-approval_rate:.1f}%)")
 
+        # Scores de todas las evaluaciones en un DataFrame (una columna por eval)
+        scores = pd.DataFrame({
+            "hallucination": [r["hallucination"]["score"] for r in eval_results],
+            "qa": [r["qa_correctness"]["score"] for r in eval_results],
+            "compliance": [r["clf_compliance"]["score"] for r in eval_results],
+            "skipped": [r["hallucination"]["label"] == "skipped" for r in eval_results]
+        })
+        judged = scores[~scores["skipped"]]
+
         # Promedios de scores
-        avg_hallucination = sum(r["hallucination"]["score"] for r in eval_results) / len(eval_results)
-        avg_qa = sum(r["qa_correctness"]["score"] for r in eval_results) / len(eval_results)
-        avg_compliance = sum(r["clf_compliance"]["score"] for r in eval_results) / len(eval_results)
+        avg_hallucination, avg_qa = judged[["hallucination", "qa"]].mean()
+        avg_compliance = scores["compliance"].mean()
 
         print(f"\n📊 Scores Promedio:")
         print(f"   Hallucination: {avg_hallucination:.3f} (menor es mejor, límite: 0.3)")
@@ -233,14 +294,17 @@ class QuestionEvaluator:
         # Distribución de rechazos
         if rejected > 0:
             print(f"\n❌ Razones de Rechazo:")
-            hall_fails = sum(1 for r in eval_results if r["hallucination"]["score"] >= 0.3)
-            qa_fails = sum(1 for r in eval_results if r["qa_correctness"]["score"] <= 0.7)
-            comp_fails = sum(1 for r in eval_results if r["clf_compliance"]["score"] < 0.9)
+            hall_fails = int((judged["hallucination"] >= 0.3).sum())
+            qa_fails = int((judged["qa"] <= 0.7).sum())
+            comp_fails = int((scores["compliance"] < 0.9).sum())
 
             print(f"   Hallucination: {hall_fails}")
             print(f"   QA Correctness: {qa_fails}")
             print(f"   CLF Compliance: {comp_fails}")
 
+        if self.skipped_evals_count:
+            print(f"\n⏭️  Evals LLM omitidas (no compliant): {self.skipped_evals_count}")
+
 
 def main():
     parser = argparse.ArgumentParser(description="Evalúa preguntas con Phoenix")
@@ -255,11 +319,13 @@ def main():
         print(f"❌ Error: {input_path} no encontrado")
         sys.exit(1)
 
-    with open(input_path, 'r', encoding='utf-8') as f:
-        questions = json.load(f)
+    questions = orjson.loads(input_path.read_bytes())
 
     print(f"\n📖 Cargadas {len(questions)} preguntas desde {input_path}")
 
+    # Recuperar contexto RAG (por chunk IDs) para el eval de hallucination
+    contexts = load_contexts(questions)
+
     # Inicializar Phoenix
     print("\n🚀 Iniciando Arize Phoenix...")
     session = px.launch_app()
@@ -267,18 +333,15 @@ def main():
 
     # Evaluar
     evaluator = QuestionEvaluator()
-    evaluator.setup_evaluators()
 
-    approved, rejected, eval_results = evaluator.evaluate_batch(questions)
+    approved, rejected, eval_results = evaluator.evaluate_batch(questions, contexts)
 
     # Guardar resultados
     output_path = DATA_DIR / args.output
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(approved, f, indent=2, ensure_ascii=False)
+    output_path.write_bytes(orjson.dumps(approved, option=orjson.OPT_INDENT_2))
 
     rejected_path = DATA_DIR / args.rejected
-    with open(rejected_path, 'w', encoding='utf-8') as f:
-        json.dump(rejected, f, indent=2, ensure_ascii=False)
+    rejected_path.write_bytes(orjson.dumps(rejected, option=orjson.OPT_INDENT_2))
 
     # Generar reporte
     evaluator.generate_report(eval_results, len(approved), len(rejected))
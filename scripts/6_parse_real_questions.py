@@ -6,14 +6,18 @@ Extrae y enriquece las preguntas reales del archivo EXAMEN REAL MAESTRO AWS.txt
 
 import os
 import sys
-import json
 import re
+import time
 from pathlib import Path
 from typing import List, Dict, Optional
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 PROJECT_ROOT = Path(__file__).parent.parent
 sys.path.insert(0, str(PROJECT_ROOT))
 
+import ahocorasick
+import orjson
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -25,6 +29,8 @@ if not os.getenv("OPENAI_API_KEY"):
 from openai import OpenAI
 from langchain_openai import OpenAIEmbeddings
 from langchain_community.vectorstores import Chroma
+from pipeline_utils import (MAX_CONCURRENT_REQUESTS, RateLimitedClient, DocumentIndex, cache_path_for,
+                            store_cached, load_checkpoint)
 from tqdm import tqdm
 
 # Configuración
@@ -34,6 +40,23 @@ OUTPUT_DIR = PROJECT_ROOT / "data"
 
 MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+EMBEDDING_BATCH_SIZE = 256  # Queries por request de embeddings (límite OpenAI: 2048)
+RAG_TOP_K = 2  # Chunks de contexto por pregunta
+CONTEXT_CHARS_PER_CHUNK = 400
+ENRICHED_MARKER = "**Respuesta correcta"  # La explicación ya tiene la estructura final
+MIN_ENRICHED_CHARS = 300
+
+# Patrones del parser (compilados una sola vez)
+QUESTION_RE = re.compile(r'^\d+\.\s*¿')
+OPTION_PREFIXES = ('A)', 'B)', 'C)', 'D)')
+CORRECT_RE = re.compile(r'Correcta:\s*([A-D])\)')
+SECTION_RE = re.compile(r'^\d+\.\d+\.')
+LOOKAHEAD_LINES = 10  # Líneas donde buscar '✔ Correcta' tras las opciones
+READ_BUFFER_SIZE = 1 << 16
+
+# Batch API de OpenAI: 50% más barato, resultados en hasta 24h
+BATCH_POLL_SECONDS = 60
+BATCH_FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
 
 # Mapeo de dominios CLF-C02
 TOPIC_TO_DOMAIN = {
@@ -95,11 +118,53 @@ TOPIC_TO_DOMAIN = {
     "caf": "Domain 1: Cloud Concepts",
 }
 
+# Automata Aho-Corasick de keywords: una sola pasada sobre el texto.
+# El valor lleva la posición en TOPIC_TO_DOMAIN para conservar su prioridad
+TOPIC_AC = ahocorasick.Automaton()
+for _rank, (_keyword, _domain) in enumerate(TOPIC_TO_DOMAIN.items()):
+    TOPIC_AC.add_word(_keyword, (_rank, _domain))
+TOPIC_AC.make_automaton()
+
+
+# Prompt de enriquecimiento: estático (se envía igual en cada request)
+ENRICH_SYSTEM_PROMPT = """Eres un experto en AWS CLF-C02.
+
+Recibes una pregunta de examen real ya revisada por un humano, su respuesta correcta, la explicación original y contexto oficial de AWS.
+Tu tarea es MEJORAR Y EXPANDIR la explicación pedagógica, fundamentándola en el contexto.
+
+Estructura de "explanation":
+**Respuesta correcta: X) ...**
+
+Por qué es la correcta...
+
+**Por qué las otras opciones son incorrectas:**
+- A) ...
+
+**Concepto clave:** ..."""
+
+# Structured outputs: el modelo solo devuelve la explicación, con JSON garantizado
+ENRICH_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "clf_explanation",
+        "schema": {
+            "type": "object",
+            "properties": {"explanation": {"type": "string"}},
+            "required": ["explanation"],
+            "additionalProperties": False
+        },
+        "strict": True
+    }
+}
+
 
 class RealQuestionParser:
     def __init__(self):
         self.client = OpenAI()
+        self.llm = RateLimitedClient(self.client)
+        self.embeddings = None
         self.vectorstore = None
+        self.index = None
         self.questions = []
 
     def load_rag_system(self):
@@ -111,30 +176,52 @@ class RealQuestionParser:
             print("   Ejecuta: python scripts/2_build_rag.py")
             sys.exit(1)
 
-        embeddings = OpenAIEmbeddings(model=EMBEDDING_MODEL)
+        self.embeddings = OpenAIEmbeddings(model=EMBEDDING_MODEL, chunk_size=EMBEDDING_BATCH_SIZE)
         self.vectorstore = Chroma(
             persist_directory=str(CHROMA_DIR),
-            embedding_function=embeddings,
+            embedding_function=self.embeddings,
             collection_name="aws_docs"
         )
-        print("   ✅ RAG system cargado")
+
+        self.index = DocumentIndex(self.vectorstore, self.embeddings, CONTEXT_CHARS_PER_CHUNK,
+                                   RAG_TOP_K, EMBEDDING_BATCH_SIZE)
+        if not len(self.index):
+            print("❌ Error: la colección aws_docs está vacía")
+            print("   Ejecuta: python scripts/2_build_rag.py")
+            sys.exit(1)
+        print(f"   ✅ RAG system cargado ({len(self.index)} chunks en memoria)")
+
+    def iter_lines(self):
+        """Lee el archivo TXT línea a línea (ya sin espacios), sin cargarlo completo"""
+        with open(INPUT_FILE, 'r', encoding='utf-8', buffering=READ_BUFFER_SIZE) as f:
+            for line in f:
+                yield line.strip()
 
     def parse_questions_from_txt(self) -> List[Dict]:
         """Extrae preguntas del archivo TXT - VERSIÓN MEJORADA"""
         print(f"\n📖 Parseando preguntas de: {INPUT_FILE.name}")
 
-        with open(INPUT_FILE, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
+        # Streaming: en memoria solo queda el lookahead de líneas aún no consumidas
+        source = self.iter_lines()
+        window = deque()
+
+        def peek(offset: int = 0) -> Optional[str]:
+            """Línea `offset` posiciones adelante sin consumirla (None al final del archivo)"""
+            while len(window) <= offset:
+                line = next(source, None)
+                if line is None:
+                    return None
+                window.append(line)
+            return window[offset]
 
         questions = []
-        i = 0
         global_question_num = 0
 
-        while i < len(lines):
-            line = lines[i].strip()
+        while peek() is not None:
+            line = window.popleft()
 
             # Detectar inicio de pregunta (número. ¿texto)
-            if re.match(r'^\d+\.\s*¿', line):
+            if '¿' in line and QUESTION_RE.match(line):
                 global_question_num += 1
 
                 # Extraer texto de pregunta
@@ -143,15 +230,16 @@ class RealQuestionParser:
                 # Buscar opciones A-D en las siguientes líneas
                 options = {}
                 correct = None
-                i += 1
 
                 # Recoger opciones
                 option_count = 0
-                while i < len(lines) and option_count < 4:
-                    current_line = lines[i].strip()
+                while option_count < 4:
+                    current_line = peek()
+                    if current_line is None:
+                        break
 
                     # Detectar opción A), B), C), D)
-                    if re.match(r'^[A-D]\)', current_line):
+                    if current_line[:2] in OPTION_PREFIXES:
                         letter = current_line[0]
                         # Extraer texto después de letra)
                         text = current_line[2:].strip()
@@ -163,46 +251,50 @@ class RealQuestionParser:
 
                         options[letter] = text
                         option_count += 1
-                        i += 1
+                        window.popleft()
                     # Si la opción continúa en siguiente línea
-                    elif option_count > 0 and option_count < 4 and not re.match(r'^\d+\.\s*¿', current_line) and current_line and not current_line.startswith('✔') and not current_line.startswith('❌'):
+                    elif option_count > 0 and option_count < 4 and not ('¿' in current_line and QUESTION_RE.match(current_line)) and current_line and not current_line.startswith('✔') and not current_line.startswith('❌'):
                         # Agregar a última opción
                         last_letter = chr(ord('A') + option_count - 1)
                         if last_letter in options:
                             options[last_letter] += ' ' + current_line
-                        i += 1
+                        window.popleft()
                     else:
                         break
 
                 # Buscar respuesta correcta en línea ✔ si no la encontramos
                 if not correct:
-                    for j in range(i, min(i + 10, len(lines))):
-                        check_line = lines[j].strip()
+                    for j in range(LOOKAHEAD_LINES):
+                        check_line = peek(j)
+                        if check_line is None:
+                            break
                         if check_line.startswith('✔') and 'Correcta:' in check_line:
                             # Extraer letra: "✔ Correcta: B)"
-                            match = re.search(r'Correcta:\s*([A-D])\)', check_line)
+                            match = CORRECT_RE.search(check_line)
                             if match:
                                 correct = match.group(1)
                                 break
 
                 # Extraer explicación (desde línea actual hasta próxima pregunta)
                 explanation_lines = []
-                while i < len(lines):
-                    current = lines[i].strip()
+                while True:
+                    current = peek()
+                    if current is None:
+                        break
 
                     # Detener si encontramos otra pregunta
-                    if re.match(r'^\d+\.\s*¿', current):
+                    if '¿' in current and QUESTION_RE.match(current):
                         break
 
                     # Detener si encontramos sección nueva
-                    if current.startswith('📌') or current.startswith('###') or re.match(r'^\d+\.\d+\.', current):
+                    if current.startswith('📌') or current.startswith('###') or SECTION_RE.match(current):
                         break
 
                     # Agregar líneas relevantes
                     if current and not current.startswith('---'):
                         explanation_lines.append(current)
 
-                    i += 1
+                    window.popleft()
 
                 explanation = ' '.join(explanation_lines)
 
@@ -213,15 +305,13 @@ class RealQuestionParser:
                         'question': question_text,
                         'options': options,
                         'correct_answer': correct,
-                        'explanation_original': explanation[:500]  # Limitar explicación
+                        'explanation_original': explanation[:500],  # Limitada para el prompt
+                        'explanation_full': explanation  # Completa, para publicarla sin LLM
                     })
                 elif question_text:
                     # Debug: mostrar preguntas incompletas
                     print(f"   ⚠️ Pregunta incompleta #{global_question_num}: opciones={len(options)}, correcta={correct}")
 
-            else:
-                i += 1
-
         print(f"   ✅ Extraídas {len(questions)} preguntas")
         return questions
 
@@ -229,97 +319,179 @@ class RealQuestionParser:
         """Infiere el dominio CLF-C02 basado en el contenido"""
         text = (question + ' ' + ' '.join(options.values())).lower()
 
-        for keyword, domain in TOPIC_TO_DOMAIN.items():
-            if keyword in text:
-                return domain
+        matches = [value for _, value in TOPIC_AC.iter(text)]
+        if matches:
+            return min(matches)[1]
 
         # Default
         return "Domain 3: Cloud Technology and Services"
 
-    def enrich_with_rag(self, question: Dict) -> Dict:
-        """Enriquece la pregunta con contexto RAG y mejora la explicación"""
-
-        # 1. Obtener contexto relevante
-        query = f"{question['question']} {' '.join(question['options'].values())}"
-        docs = self.vectorstore.similarity_search(query, k=2)
-        context = "\n\n".join([doc.page_content[:400] for doc in docs])
-
-        # 2. Inferir dominio
-        domain = self.infer_domain(question['question'], question['options'])
-
-        # 3. Mejorar explicación con GPT-4o-mini
-        system_prompt = f"""Eres un experto en AWS CLF-C02.
-
-Tienes una pregunta de examen real que ya fue revisada por un humano.
-Tu tarea es MEJORAR Y EXPANDIR la explicación pedagógica usando el contexto oficial de AWS proporcionado.
+    def needs_enrichment(self, question: Dict) -> bool:
+        """False si la explicación original ya está estructurada y es suficientemente larga"""
+        explanation = question['explanation_full']
+        return not (ENRICHED_MARKER in explanation and len(explanation) > MIN_ENRICHED_CHARS)
 
-CONTEXTO AWS OFICIAL:
-{context}
-
-IMPORTANTE:
-- Mantén la pregunta y opciones EXACTAMENTE como están (no las modifiques)
-- Mantén la respuesta correcta ({question['correct_answer']})
-- MEJORA la explicación para que sea más completa y pedagógica
-- Usa el contexto oficial de AWS para fundamentar la explicación
-- Estructura: **Respuesta correcta**, Por qué las otras son incorrectas, Concepto clave
-- Responde SOLO con JSON válido"""
-
-        user_prompt = f"""Pregunta existente:
+    def build_enrich_request(self, question: Dict, context: str) -> Dict:
+        """Parámetros de chat.completions para enriquecer una pregunta (modo síncrono y Batch API)"""
+        # System estático, solo datos en el user
+        options_json = orjson.dumps(question['options'], option=orjson.OPT_INDENT_2).decode()
+        user_prompt = f"""Pregunta:
 {question['question']}
 
 Opciones:
-{json.dumps(question['options'], indent=2, ensure_ascii=False)}
+{options_json}
 
 Respuesta correcta: {question['correct_answer']}
 
 Explicación original: {question['explanation_original']}
 
-Genera un JSON con esta estructura:
-{{
-  "question": "{question['question']}",
-  "options": {json.dumps(question['options'], ensure_ascii=False)},
-  "correct_answer": "{question['correct_answer']}",
-  "explanation": "**Respuesta correcta: {question['correct_answer']}) ...**\\n\\nExplicación mejorada...\\n\\n**Por qué las otras opciones son incorrectas:**\\n- A) ...\\n- C) ...\\n- D) ...\\n\\n**Concepto clave:** ...",
-  "domain": "{domain}"
-}}
+CONTEXTO AWS OFICIAL:
+{context}"""
+
+        return {
+            "model": MODEL,
+            "messages": [
+                {"role": "system", "content": ENRICH_SYSTEM_PROMPT},
+                {"role": "user", "content": user_prompt}
+            ],
+            "temperature": 0.7,
+            "response_format": ENRICH_RESPONSE_FORMAT
+        }
+
+    def enrich_with_rag(self, question: Dict, context: str) -> Dict:
+        """Enriquece la pregunta con contexto RAG y mejora la explicación"""
 
-IMPORTANTE: No cambies la pregunta ni las opciones, solo mejora la explicación."""
+        # 1. Inferir dominio
+        domain = self.infer_domain(question['question'], question['options'])
 
-        try:
-            response = self.client.chat.completions.create(
-                model=MODEL,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                temperature=0.7,
-                response_format={"type": "json_object"}
-            )
+        # Explicación ya completa: no hace falta llamar al LLM
+        if not self.needs_enrichment(question):
+            return {
+                'number': question['number'],
+                'question': question['question'],
+                'options': question['options'],
+                'correct_answer': question['correct_answer'],
+                'explanation': question['explanation_full'],
+                'domain': domain,
+                'source': 'real_exam_validated_by_human',
+                'retrieved_context': context[:500]
+            }
 
-            enriched = json.loads(response.choices[0].message.content)
+        # 2. Mejorar explicación con GPT-4o-mini
+        try:
+            content = self.llm.complete_cached(**self.build_enrich_request(question, context))
 
-            # Asegurar campos requeridos
-            enriched['domain'] = domain  # Forzar dominio inferido
-            enriched['retrieved_context'] = context[:500]
-            enriched['source'] = 'real_exam_validated_by_human'
+            explanation = orjson.loads(content)['explanation']
 
-            return enriched
+            # Pregunta, opciones y respuesta se conservan tal cual; solo cambia la explicación
+            return {
+                'number': question['number'],  # Clave para --resume
+                'question': question['question'],
+                'options': question['options'],
+                'correct_answer': question['correct_answer'],
+                'explanation': explanation,
+                'domain': domain,
+                'source': 'real_exam_validated_by_human',
+                'retrieved_context': context[:500]
+            }
 
         except Exception as e:
-            print(f"   ⚠️ Error enriqueciendo pregunta {question['number']}: {e}")
+            tqdm.write(f"   ⚠️ Error enriqueciendo pregunta {question['number']}: {e}")
             # Fallback: devolver pregunta original con formato mínimo
             return {
+                'number': question['number'],
                 'question': question['question'],
                 'options': question['options'],
                 'correct_answer': question['correct_answer'],
-                'explanation': question['explanation_original'],
+                'explanation': question['explanation_full'],
                 'domain': domain,
                 'source': 'real_exam_validated_by_human',
                 'retrieved_context': ''
             }
 
-    def process_all(self, output_file: str = "questions_real_enriched.json", limit: Optional[int] = None):
-        """Procesa todas las preguntas"""
+    def prefill_cache_with_batch(self, questions: List[Dict], contexts: List[str], batch_input_path: Path):
+        """Resuelve los enriquecimientos pendientes con el Batch API de OpenAI (50% más barato)
+
+        Las respuestas se guardan en la caché de disco bajo la misma clave que
+        usa complete_cached, así el enriquecimiento normal las reutiliza sin
+        llamar a la API. Las requests que fallen en el batch se resuelven
+        después en modo síncrono.
+        """
+        # 1. Una request por pregunta sin explicación completa ni respuesta en caché
+        cache_paths = {}
+        with open(batch_input_path, 'wb') as f:
+            for question, context in zip(questions, contexts):
+                if not self.needs_enrichment(question):
+                    continue
+                body = self.build_enrich_request(question, context)
+                cache_path = cache_path_for(body)
+                if cache_path.exists():
+                    continue
+
+                custom_id = f"q{question['number']}"
+                cache_paths[custom_id] = cache_path
+                request = {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}
+                f.write(orjson.dumps(request) + b"\n")
+
+        if not cache_paths:
+            print("   ✅ Todas las respuestas ya están en caché, no se envía batch")
+            return
+
+        # 2. Subir archivo y crear batch
+        with open(batch_input_path, 'rb') as f:
+            batch_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        print(f"   📤 Batch enviado: {batch.id} ({len(cache_paths)} requests)")
+
+        # 3. Esperar a que termine
+        while batch.status not in BATCH_FINAL_STATUSES:
+            time.sleep(BATCH_POLL_SECONDS)
+            batch = self.client.batches.retrieve(batch.id)
+            counts = batch.request_counts
+            if counts:
+                print(f"   ⏳ {batch.status}: {counts.completed}/{counts.total} completadas")
+
+        if batch.status != "completed" or not batch.output_file_id:
+            print(f"   ⚠️ Batch {batch.id} terminó con estado: {batch.status} (se usará el modo síncrono)")
+            return
+
+        # 4. Descargar resultados a la caché por custom_id
+        cached_count = 0
+        results = self.client.files.content(batch.output_file_id)
+        for line in results.iter_lines():
+            if not line.strip():
+                continue
+            result = orjson.loads(line)
+            response = result.get("response") or {}
+            if result.get("error") or response.get("status_code") != 200:
+                continue
+
+            content = response["body"]["choices"][0]["message"].get("content")
+            cache_path = cache_paths.get(result["custom_id"])
+            if content is not None and cache_path is not None:
+                store_cached(cache_path, content)
+                cached_count += 1
+
+        print(f"   📥 {cached_count}/{len(cache_paths)} respuestas del batch guardadas en caché")
+
+    def save_output(self, jsonl_path: Path, output_path: Path) -> List[Dict]:
+        """Convierte el JSONL a JSON (formato que consume el script 7)"""
+        questions = load_checkpoint(jsonl_path)
+        output_path.write_bytes(orjson.dumps(questions, option=orjson.OPT_INDENT_2))
+        return questions
+
+    def process_all(self, output_file: str = "questions_real_enriched.json", limit: Optional[int] = None,
+                    concurrency: int = MAX_CONCURRENT_REQUESTS, resume: bool = False, batch: bool = False):
+        """Procesa todas las preguntas
+
+        Cada pregunta enriquecida se escribe al JSONL en cuanto termina, así
+        un fallo no pierde lo ya procesado; al final se convierte al JSON.
+        Con batch, las llamadas al LLM se resuelven antes con el Batch API.
+        """
 
         # 1. Parsear preguntas
         raw_questions = self.parse_questions_from_txt()
@@ -333,20 +505,42 @@ IMPORTANTE: No cambies la pregunta ni las opciones, solo mejora la explicación.
             raw_questions = raw_questions[:limit]
             print(f"   ℹ️ Limitando a primeras {limit} preguntas para prueba")
 
+        output_path = OUTPUT_DIR / output_file
+        jsonl_path = output_path.with_suffix(".jsonl")
+
+        # Reanudar: saltar las preguntas ya enriquecidas en el JSONL
+        if resume:
+            done = {q.get('number') for q in load_checkpoint(jsonl_path)}
+            raw_questions = [q for q in raw_questions if q['number'] not in done]
+            print(f"   ♻️  Reanudando: {len(done)} preguntas previas, {len(raw_questions)} pendientes")
+
         # 2. Enriquecer con RAG
         print(f"\n🚀 Enriqueciendo {len(raw_questions)} preguntas con RAG")
         print("="*70)
 
-        enriched_questions = []
-        for q in tqdm(raw_questions, desc="Enriqueciendo"):
-            enriched = self.enrich_with_rag(q)
-            if enriched:
-                enriched_questions.append(enriched)
+        skipped = sum(not self.needs_enrichment(q) for q in raw_questions)
+        if skipped:
+            print(f"   ⏭️  {skipped} preguntas ya tienen explicación completa (sin llamada al LLM)")
+
+        # Un solo batch de embeddings para todas las preguntas
+        print("🔎 Recuperando contexto RAG...")
+        contexts = self.index.retrieve_contexts(raw_questions)
+
+        if batch:
+            print("📦 Enviando enriquecimientos al Batch API...")
+            batch_input_path = output_path.with_name(f"{output_path.stem}_batch_input.jsonl")
+            self.prefill_cache_with_batch(raw_questions, contexts, batch_input_path)
+
+        # Enriquecer en paralelo (I/O-bound); map conserva el orden original
+        with open(jsonl_path, 'ab' if resume else 'wb') as out, \
+                ThreadPoolExecutor(max_workers=concurrency) as ex:
+            for enriched in tqdm(ex.map(self.enrich_with_rag, raw_questions, contexts),
+                                 total=len(raw_questions), desc="Enriqueciendo"):
+                out.write(orjson.dumps(enriched) + b"\n")
+                out.flush()
 
         # 3. Guardar
-        output_path = OUTPUT_DIR / output_file
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(enriched_questions, f, indent=2, ensure_ascii=False)
+        enriched_questions = self.save_output(jsonl_path, output_path)
 
         # 4. Resumen
         print("\n" + "="*70)
@@ -375,11 +569,15 @@ def main():
     import argparse
     arg_parser = argparse.ArgumentParser(description="Parsea y enriquece preguntas reales")
     arg_parser.add_argument("--limit", type=int, help="Limitar número de preguntas (para pruebas)")
+    arg_parser.add_argument("--concurrency", type=int, default=MAX_CONCURRENT_REQUESTS, help="Requests a OpenAI en paralelo")
+    arg_parser.add_argument("--resume", action="store_true", help="Continuar desde el JSONL de una ejecución interrumpida")
+    arg_parser.add_argument("--batch", action="store_true", help="Usar el Batch API de OpenAI (50%% más barato, hasta 24h)")
     args = arg_parser.parse_args()
 
     parser = RealQuestionParser()
     parser.load_rag_system()
-    questions = parser.process_all(limit=args.limit)
+    questions = parser.process_all(limit=args.limit, concurrency=args.concurrency, resume=args.resume,
+                                  batch=args.batch)
 
     # Preview
     if questions:
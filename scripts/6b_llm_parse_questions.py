@@ -7,15 +7,20 @@ Maneja formatos inconsistentes usando AI
 
 import os
 import sys
-import json
-import re
+import hashlib
+import threading
 from pathlib import Path
 from typing import List, Dict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 PROJECT_ROOT = Path(__file__).parent.parent
 sys.path.insert(0, str(PROJECT_ROOT))
 
+import ahocorasick
+import numpy as np
+import orjson
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -26,6 +31,7 @@ if not os.getenv("OPENAI_API_KEY"):
 from openai import OpenAI
 from langchain_openai import OpenAIEmbeddings
 from langchain_community.vectorstores import Chroma
+from pipeline_utils import MAX_CONCURRENT_REQUESTS, RateLimitedClient, DocumentIndex, load_checkpoint
 
 # Configuración
 CHROMA_DIR = PROJECT_ROOT / "data" / "chroma_db"
@@ -34,6 +40,9 @@ OUTPUT_DIR = PROJECT_ROOT / "data"
 
 MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+EMBEDDING_BATCH_SIZE = 256  # Queries por request de embeddings (límite OpenAI: 2048)
+RAG_TOP_K = 2  # Chunks de contexto por pregunta
+CONTEXT_CHARS_PER_CHUNK = 400
 
 # Dominio mapping (mismo que antes)
 TOPIC_TO_DOMAIN = {
@@ -78,11 +87,106 @@ TOPIC_TO_DOMAIN = {
     "caf": "Domain 1: Cloud Concepts",
 }
 
+# Automata Aho-Corasick de keywords: una sola pasada sobre el texto.
+# El valor lleva la posición en TOPIC_TO_DOMAIN para conservar su prioridad
+TOPIC_AC = ahocorasick.Automaton()
+for _rank, (_keyword, _domain) in enumerate(TOPIC_TO_DOMAIN.items()):
+    TOPIC_AC.add_word(_keyword, (_rank, _domain))
+TOPIC_AC.make_automaton()
+
+
+# Prompt de extracción: estático (el chunk va en el mensaje del usuario)
+EXTRACT_SYSTEM_PROMPT = """Eres un parser especializado en extraer preguntas de examen AWS de documentos de estudio.
+
+Tu tarea es identificar TODAS las preguntas de examen en el texto proporcionado y extraerlas en formato JSON.
+
+Formato de preguntas en el texto:
+- Empiezan con número seguido de punto: "1. ¿Pregunta?"
+- Tienen 4 opciones (A, B, C, D)
+- Una opción tiene ✅ marcando la correcta
+- Puede haber explicación después
+
+IMPORTANTE:
+- Extrae TODAS las preguntas que encuentres
+- Si una pregunta no tiene las 4 opciones completas, ignórala
+- Si no puedes determinar la respuesta correcta, usa null
+- NO inventes información, solo extrae lo que está en el texto"""
+
+# Structured outputs: lista de preguntas con JSON garantizado
+EXTRACT_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "clf_extracted_questions",
+        "schema": {
+            "type": "object",
+            "properties": {
+                "questions": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "question": {"type": "string"},
+                            "options": {
+                                "type": "object",
+                                "properties": {letter: {"type": "string"} for letter in "ABCD"},
+                                "required": list("ABCD"),
+                                "additionalProperties": False
+                            },
+                            "correct_answer": {
+                                "anyOf": [{"type": "string", "enum": list("ABCD")}, {"type": "null"}]
+                            }
+                        },
+                        "required": ["question", "options", "correct_answer"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["questions"],
+            "additionalProperties": False
+        },
+        "strict": True
+    }
+}
+
+# Prompt de enriquecimiento: estático (se envía igual en cada request)
+ENRICH_SYSTEM_PROMPT = """Eres un experto en AWS CLF-C02.
+
+Recibes una pregunta de examen real, su respuesta correcta y contexto oficial de AWS.
+Tu tarea es crear una explicación pedagógica completa fundamentada en el contexto.
+
+Estructura de "explanation":
+**Respuesta correcta: X) ...**
+
+...
+
+**Por qué las otras opciones son incorrectas:**
+- A) ...
+
+**Concepto clave:** ..."""
+
+# Structured outputs: el modelo solo devuelve la explicación, con JSON garantizado
+ENRICH_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "clf_explanation",
+        "schema": {
+            "type": "object",
+            "properties": {"explanation": {"type": "string"}},
+            "required": ["explanation"],
+            "additionalProperties": False
+        },
+        "strict": True
+    }
+}
+
 
 class LLMQuestionParser:
     def __init__(self):
         self.client = OpenAI()
+        self.llm = RateLimitedClient(self.client)
+        self.embeddings = None
         self.vectorstore = None
+        self.index = None
 
     def load_rag_system(self):
         """Carga el sistema RAG"""
@@ -93,170 +197,119 @@ class LLMQuestionParser:
             print("   Ejecuta: python scripts/2_build_rag.py")
             sys.exit(1)
 
-        embeddings = OpenAIEmbeddings(model=EMBEDDING_MODEL)
+        self.embeddings = OpenAIEmbeddings(model=EMBEDDING_MODEL, chunk_size=EMBEDDING_BATCH_SIZE)
         self.vectorstore = Chroma(
             persist_directory=str(CHROMA_DIR),
-            embedding_function=embeddings,
+            embedding_function=self.embeddings,
             collection_name="aws_docs"
         )
-        print("   ✅ RAG system cargado")
 
-    def split_into_chunks(self, text: str, chunk_size: int = 3000) -> List[str]:
-        """Divide el texto en chunks para procesar con LLM"""
-        lines = text.split('\n')
-        chunks = []
-        current_chunk = []
-        current_size = 0
+        self.index = DocumentIndex(self.vectorstore, self.embeddings, CONTEXT_CHARS_PER_CHUNK,
+                                   RAG_TOP_K, EMBEDDING_BATCH_SIZE)
+        if not len(self.index):
+            print("❌ Error: la colección aws_docs está vacía")
+            print("   Ejecuta: python scripts/2_build_rag.py")
+            sys.exit(1)
+        print(f"   ✅ RAG system cargado ({len(self.index)} chunks en memoria)")
 
-        for line in lines:
-            line_size = len(line) + 1
-            if current_size + line_size > chunk_size and current_chunk:
-                chunks.append('\n'.join(current_chunk))
-                current_chunk = []
-                current_size = 0
+    def split_into_chunks(self, text: str, chunk_size: int = 3000) -> List[str]:
+        """Divide el texto en chunks de líneas completas para procesar con LLM
 
-            current_chunk.append(line)
-            current_size += line_size
+        Los cortes se buscan con searchsorted sobre el tamaño acumulado de las
+        líneas (una iteración por chunk, no por línea).
+        """
+        lines = text.split('\n')
+        sizes = np.fromiter(map(len, lines), dtype=np.int64, count=len(lines)) + 1
+        cumulative = np.cumsum(sizes)
 
-        if current_chunk:
-            chunks.append('\n'.join(current_chunk))
+        chunks = []
+        start = 0
+        while start < len(lines):
+            base = cumulative[start - 1] if start else 0
+            end = int(np.searchsorted(cumulative, base + chunk_size, side='right'))
+            end = max(end, start + 1)  # Una línea más larga que chunk_size va sola
+            chunks.append('\n'.join(lines[start:end]))
+            start = end
 
         return chunks
 
     def extract_questions_from_chunk(self, chunk: str) -> List[Dict]:
         """Usa LLM para extraer preguntas de un chunk de texto"""
 
-        system_prompt = """Eres un parser especializado en extraer preguntas de examen AWS de documentos de estudio.
-
-Tu tarea es identificar TODAS las preguntas de examen en el texto proporcionado y extraerlas en formato JSON.
-
-Formato de preguntas en el texto:
-- Empiezan con número seguido de punto: "1. ¿Pregunta?"
-- Tienen 4 opciones (A, B, C, D)
-- Una opción tiene ✅ marcando la correcta
-- Puede haber explicación después
-
-IMPORTANTE:
-- Extrae TODAS las preguntas que encuentres
-- Si una pregunta no tiene las 4 opciones completas, ignórala
-- Si no puedes determinar la respuesta correcta, usa null
-- NO inventes información, solo extrae lo que está en el texto
-
-Responde SOLO con un JSON array de preguntas."""
-
         user_prompt = f"""Extrae todas las preguntas de examen del siguiente texto:
 
-{chunk}
-
-Formato de salida:
-[
-  {{
-    "question": "¿Texto de la pregunta?",
-    "options": {{
-      "A": "Opción A",
-      "B": "Opción B",
-      "C": "Opción C",
-      "D": "Opción D"
-    }},
-    "correct_answer": "B"
-  }}
-]
-
-Responde SOLO con el JSON array, sin texto adicional."""
+{chunk}"""
 
         try:
-            response = self.client.chat.completions.create(
+            content = self.llm.complete_cached(
                 model=MODEL,
                 messages=[
-                    {"role": "system", "content": system_prompt},
+                    {"role": "system", "content": EXTRACT_SYSTEM_PROMPT},
                     {"role": "user", "content": user_prompt}
                 ],
                 temperature=0.1,  # Baja creatividad para extracción precisa
-                response_format={"type": "json_object"}
+                response_format=EXTRACT_RESPONSE_FORMAT
             )
 
-            content = response.choices[0].message.content
-
-            # El LLM puede devolver {"questions": [...]} o directamente [...]
-            parsed = json.loads(content)
-            if isinstance(parsed, dict) and 'questions' in parsed:
-                return parsed['questions']
-            elif isinstance(parsed, list):
-                return parsed
-            else:
-                return []
+            # El esquema garantiza {"questions": [...]} con 4 opciones por pregunta
+            return orjson.loads(content)['questions']
 
         except Exception as e:
-            print(f"   ⚠️ Error parseando chunk: {e}")
+            tqdm.write(f"   ⚠️ Error parseando chunk: {e}")
             return []
 
     def infer_domain(self, question: str, options: Dict[str, str]) -> str:
         """Infiere el dominio CLF-C02"""
         text = (question + ' ' + ' '.join(options.values())).lower()
 
-        for keyword, domain in TOPIC_TO_DOMAIN.items():
-            if keyword in text:
-                return domain
+        matches = [value for _, value in TOPIC_AC.iter(text)]
+        if matches:
+            return min(matches)[1]
 
         return "Domain 3: Cloud Technology and Services"
 
-    def enrich_with_rag(self, question: Dict) -> Dict:
+    def enrich_with_rag(self, question: Dict, context: str) -> Dict:
         """Enriquece explicación con RAG"""
 
-        query = f"{question['question']} {' '.join(question['options'].values())}"
-        docs = self.vectorstore.similarity_search(query, k=2)
-        context = "\n\n".join([doc.page_content[:400] for doc in docs])
-
         domain = self.infer_domain(question['question'], question['options'])
 
-        system_prompt = f"""Eres un experto en AWS CLF-C02.
-
-Tienes una pregunta de examen real. Tu tarea es crear una explicación pedagógica completa usando el contexto oficial de AWS.
-
-CONTEXTO AWS OFICIAL:
-{context}
-
-Mantén la pregunta, opciones y respuesta correcta EXACTAMENTE como están.
-Genera una explicación estructurada y completa.
-Responde SOLO con JSON válido."""
-
+        # System estático; el user solo lleva los datos de la pregunta y el contexto
+        options_json = orjson.dumps(question['options'], option=orjson.OPT_INDENT_2).decode()
         user_prompt = f"""Pregunta:
 {question['question']}
 
 Opciones:
-{json.dumps(question['options'], indent=2, ensure_ascii=False)}
+{options_json}
 
 Respuesta correcta: {question['correct_answer']}
 
-Genera un JSON:
-{{
-  "question": "{question['question']}",
-  "options": {json.dumps(question['options'], ensure_ascii=False)},
-  "correct_answer": "{question['correct_answer']}",
-  "explanation": "**Respuesta correcta: {question['correct_answer']}) ...**\\n\\n...\\n\\n**Por qué las otras opciones son incorrectas:**\\n- A) ...\\n\\n**Concepto clave:** ...",
-  "domain": "{domain}"
-}}"""
+CONTEXTO AWS OFICIAL:
+{context}"""
 
         try:
-            response = self.client.chat.completions.create(
+            content = self.llm.complete_cached(
                 model=MODEL,
                 messages=[
-                    {"role": "system", "content": system_prompt},
+                    {"role": "system", "content": ENRICH_SYSTEM_PROMPT},
                     {"role": "user", "content": user_prompt}
                 ],
                 temperature=0.7,
-                response_format={"type": "json_object"}
+                response_format=ENRICH_RESPONSE_FORMAT
             )
 
-            enriched = json.loads(response.choices[0].message.content)
-            enriched['domain'] = domain
-            enriched['retrieved_context'] = context[:500]
-            enriched['source'] = 'real_exam_validated_by_human'
-
-            return enriched
+            explanation = orjson.loads(content)['explanation']
+            return {
+                'question': question['question'],
+                'options': question['options'],
+                'correct_answer': question['correct_answer'],
+                'explanation': explanation,
+                'domain': domain,
+                'source': 'real_exam_validated_by_human',
+                'retrieved_context': context[:500]
+            }
 
         except Exception as e:
-            print(f"   ⚠️ Error enriqueciendo: {e}")
+            tqdm.write(f"   ⚠️ Error enriqueciendo: {e}")
             return {
                 'question': question['question'],
                 'options': question['options'],
@@ -267,8 +320,21 @@ Genera un JSON:
                 'retrieved_context': ''
             }
 
-    def process_all(self, output_file: str = "questions_real_enriched.json"):
-        """Procesa TODO el archivo usando LLM"""
+    def save_output(self, jsonl_path: Path, output_path: Path) -> List[Dict]:
+        """Convierte el JSONL a JSON (formato que consume el script 7)"""
+        questions = load_checkpoint(jsonl_path)
+        output_path.write_bytes(orjson.dumps(questions, option=orjson.OPT_INDENT_2))
+        return questions
+
+    def process_all(self, output_file: str = "questions_real_enriched.json",
+                    concurrency: int = MAX_CONCURRENT_REQUESTS, resume: bool = False):
+        """Procesa TODO el archivo usando LLM
+
+        Extracción y enriquecimiento van en pipeline: las preguntas de cada
+        chunk se enriquecen mientras se extraen los siguientes. Cada pregunta
+        enriquecida se escribe al JSONL en cuanto termina; con resume se vuelve
+        a extraer el texto pero se saltan las preguntas ya enriquecidas.
+        """
 
         print(f"\n📖 Leyendo archivo: {INPUT_FILE.name}")
         with open(INPUT_FILE, 'r', encoding='utf-8') as f:
@@ -278,35 +344,74 @@ Genera un JSON:
         chunks = self.split_into_chunks(full_text, chunk_size=4000)
         print(f"   📄 Dividido en {len(chunks)} chunks")
 
-        # Extraer preguntas de cada chunk
-        print(f"\n🤖 Extrayendo preguntas con LLM...")
-        all_questions = []
-        seen_questions = set()  # Deduplicar
-
-        for i, chunk in enumerate(tqdm(chunks, desc="Procesando chunks"), 1):
-            questions = self.extract_questions_from_chunk(chunk)
-
-            for q in questions:
-                # Deduplicar por texto de pregunta
-                if q['question'] not in seen_questions:
-                    seen_questions.add(q['question'])
-                    all_questions.append(q)
-
-        print(f"\n   ✅ Extraídas {len(all_questions)} preguntas únicas")
-
-        # Enriquecer con RAG
-        print(f"\n🚀 Enriqueciendo con RAG...")
-        enriched_questions = []
-
-        for q in tqdm(all_questions, desc="Enriqueciendo"):
-            enriched = self.enrich_with_rag(q)
-            if enriched:
-                enriched_questions.append(enriched)
+        output_path = OUTPUT_DIR / output_file
+        jsonl_path = output_path.with_suffix(".jsonl")
+
+        # Reanudar: saltar las preguntas ya enriquecidas en el JSONL
+        done = set()
+        if resume:
+            done = {q.get('question') for q in load_checkpoint(jsonl_path)}
+            print(f"   ♻️  Reanudando: {len(done)} preguntas previas")
+
+        # Pipeline: cada chunk extraído pasa directo a RAG + enriquecimiento
+        # mientras los demás chunks se siguen extrayendo
+        print(f"\n🤖 Extrayendo y enriqueciendo preguntas con LLM...")
+        seen_questions = set()  # Digests de 16 bytes, no el texto completo
+        pending = deque()  # Futures de enriquecimiento en orden de extracción
+        total_questions = 0
+
+        # Extracción y enriquecimiento comparten un solo cupo de `concurrency`
+        # requests en vuelo (dos pools de `concurrency` hilos duplicarían el límite)
+        llm_slots = threading.BoundedSemaphore(concurrency)
+
+        def with_slot(fn):
+            def run(*args):
+                with llm_slots:
+                    return fn(*args)
+            return run
+
+        extract = with_slot(self.extract_questions_from_chunk)
+        enrich = with_slot(self.enrich_with_rag)
+
+        with open(jsonl_path, 'ab' if resume else 'wb') as out, \
+                ThreadPoolExecutor(max_workers=concurrency) as extract_ex, \
+                ThreadPoolExecutor(max_workers=concurrency) as enrich_ex, \
+                tqdm(total=0, desc="Enriqueciendo") as bar:
+
+            def write_ready(wait: bool = False):
+                """Escribe al JSONL los enriquecimientos terminados, respetando el orden"""
+                while pending and (wait or pending[0].done()):
+                    out.write(orjson.dumps(pending.popleft().result()) + b"\n")
+                    out.flush()
+                    bar.update(1)
+
+            # map conserva el orden de los chunks
+            for questions in tqdm(extract_ex.map(extract, chunks),
+                                  total=len(chunks), desc="Procesando chunks"):
+                new_questions = []
+                for q in questions:
+                    # Deduplicar por texto de pregunta (sin distinguir mayúsculas/espacios)
+                    normalized = ' '.join(q['question'].lower().split())
+                    key = hashlib.blake2b(normalized.encode(), digest_size=16).digest()
+                    if key not in seen_questions:
+                        seen_questions.add(key)
+                        total_questions += 1
+                        if q['question'] not in done:
+                            new_questions.append(q)
+
+                contexts = self.index.retrieve_contexts(new_questions)
+                for q, context in zip(new_questions, contexts):
+                    pending.append(enrich_ex.submit(enrich, q, context))
+                bar.total += len(new_questions)
+                bar.refresh()
+                write_ready()
+
+            write_ready(wait=True)
+
+        print(f"\n   ✅ Extraídas {total_questions} preguntas únicas")
 
         # Guardar
-        output_path = OUTPUT_DIR / output_file
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(enriched_questions, f, indent=2, ensure_ascii=False)
+        enriched_questions = self.save_output(jsonl_path, output_path)
 
         # Resumen
         print("\n" + "="*70)
@@ -333,11 +438,13 @@ def main():
     import argparse
     parser = argparse.ArgumentParser(description="Parsea preguntas usando LLM")
     parser.add_argument("--output", default="questions_real_enriched.json", help="Archivo de salida")
+    parser.add_argument("--concurrency", type=int, default=MAX_CONCURRENT_REQUESTS, help="Requests a OpenAI en paralelo")
+    parser.add_argument("--resume", action="store_true", help="Continuar desde el JSONL de una ejecución interrumpida")
     args = parser.parse_args()
 
     llm_parser = LLMQuestionParser()
     llm_parser.load_rag_system()
-    questions = llm_parser.process_all(args.output)
+    questions = llm_parser.process_all(args.output, concurrency=args.concurrency, resume=args.resume)
 
     # Preview
     if questions:
@@ -4,39 +4,72 @@ Script 7: Merge Questions
 Combina preguntas reales enriquecidas con preguntas generadas para el simulador
 """
 
-import json
+import os
 import sys
+from collections import Counter
 from pathlib import Path
-from typing import List, Dict
+from typing import Dict, Iterable, Iterator, Generator
+
+import ijson
+import orjson
 
 PROJECT_ROOT = Path(__file__).parent.parent
 DATA_DIR = PROJECT_ROOT / "data"
 
-def load_questions(filename: str) -> List[Dict]:
-    """Carga preguntas desde un archivo JSON"""
+# Mismo formato que orjson.dumps({'questions': [...]}, OPT_INDENT_2), escrito pregunta a pregunta
+OUTPUT_HEADER = b'{\n  "questions": ['
+OUTPUT_FOOTER = b'\n  ]\n}'
+RECORD_INDENT = b'\n    '
+
+# Valores por defecto de campos ausentes
+DEFAULT_DOMAIN = "Domain 3: Cloud Technology and Services"  # Dominio para el simulador
+UNKNOWN_DOMAIN = "Unknown"  # Dominio en la distribución del resumen
+DEFAULT_SOURCE = "generated"
+
+def load_questions(filename: str) -> Generator[Dict, None, int]:
+    """Recorre las preguntas de un archivo JSON sin cargarlo completo
+
+    Generador: devuelve (como valor de retorno) cuántas preguntas leyó.
+    """
     filepath = DATA_DIR / filename
     if not filepath.exists():
         print(f"⚠️ Archivo no encontrado: {filepath}")
-        return []
+        return 0
 
-    with open(filepath, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    count = 0
+    with open(filepath, 'rb') as f:
+        first = f.peek(64).lstrip()[:1]
 
-    # Si es un array directo, devolverlo
-    if isinstance(data, list):
-        return data
-    # Si tiene wrapper "questions", extraerlo
-    elif isinstance(data, dict) and 'questions' in data:
-        return data['questions']
-    else:
-        print(f"⚠️ Formato desconocido en {filename}")
-        return []
+        # Array directo o wrapper "questions"
+        if first == b'[':
+            prefix = 'item'
+        elif first == b'{':
+            prefix = 'questions.item'
+        else:
+            print(f"⚠️ Formato desconocido en {filename}")
+            return 0
+
+        for q in ijson.items(f, prefix, use_float=True):
+            count += 1
+            yield q
+
+        # Objeto sin preguntas: distinguir wrapper vacío de formato desconocido
+        if not count and prefix == 'questions.item':
+            f.seek(0)
+            if not any(path == '' and event == 'map_key' and value == 'questions'
+                       for path, event, value in ijson.parse(f)):
+                print(f"⚠️ Formato desconocido en {filename}")
+
+    return count
 
 
-def format_for_simulator(questions: List[Dict]) -> Dict:
-    """Formatea preguntas para el simulador"""
+def format_for_simulator(questions: Iterable[Dict], domain_count: Counter,
+                         source_count: Counter) -> Iterator[Dict]:
+    """Formatea preguntas para el simulador
+
+    Generador: en la misma pasada cuenta las preguntas por dominio y por fuente.
+    """
 
-    formatted = []
     for i, q in enumerate(questions, 1):
         # Asegurar que tiene todos los campos requeridos
         formatted_q = {
@@ -45,7 +78,7 @@ def format_for_simulator(questions: List[Dict]) -> Dict:
             'options': q.get('options', {}),
             'correctAnswer': q.get('correct_answer') or q.get('correctAnswer', ''),
             'explanation': q.get('explanation', ''),
-            'domain': q.get('domain', 'Domain 3: Cloud Technology and Services'),
+            'domain': q.get('domain', DEFAULT_DOMAIN),
         }
 
         # Campos opcionales
@@ -56,82 +89,104 @@ def format_for_simulator(questions: List[Dict]) -> Dict:
         if 'scenario' in q:
             formatted_q['scenario'] = q['scenario']
 
-        formatted.append(formatted_q)
-
-    return {'questions': formatted}
+        # Distribución (sobre los valores originales, no los del simulador)
+        domain_count[q.get('domain', UNKNOWN_DOMAIN)] += 1
+        source_count[q.get('source', DEFAULT_SOURCE)] += 1
 
+        yield formatted_q
 
-def merge_questions():
-    """Combina todas las preguntas disponibles"""
-
-    print("🔄 Combinando preguntas para el simulador")
-    print("="*70)
 
-    all_questions = []
+def iter_source_questions() -> Iterator[Dict]:
+    """Recorre las preguntas de todas las fuentes, una a una y en orden"""
 
     # 1. Cargar preguntas reales enriquecidas
-    real_questions = load_questions("questions_real_enriched.json")
-    if real_questions:
-        print(f"✅ Preguntas reales validadas: {len(real_questions)}")
-        all_questions.extend(real_questions)
+    real_count = yield from load_questions("questions_real_enriched.json")
+    if real_count:
+        print(f"✅ Preguntas reales validadas: {real_count}")
     else:
         print("⚠️ No se encontraron preguntas reales enriquecidas")
         print("   Ejecuta: python scripts/6_parse_real_questions.py")
 
     # 2. Cargar preguntas generadas evaluadas (si existen)
-    evaluated_questions = load_questions("questions_evaluated.json")
-    if evaluated_questions:
-        print(f"✅ Preguntas generadas (evaluadas): {len(evaluated_questions)}")
-        all_questions.extend(evaluated_questions)
+    evaluated_count = yield from load_questions("questions_evaluated.json")
+    if evaluated_count:
+        print(f"✅ Preguntas generadas (evaluadas): {evaluated_count}")
 
     # 3. Si no hay evaluated, usar las raw
-    if not evaluated_questions:
-        raw_questions = load_questions("questions_raw.json")
-        if raw_questions:
-            print(f"⚠️ Usando preguntas raw (no evaluadas): {len(raw_questions)}")
-            all_questions.extend(raw_questions)
+    if not evaluated_count:
+        raw_count = yield from load_questions("questions_raw.json")
+        if raw_count:
+            print(f"⚠️ Usando preguntas raw (no evaluadas): {raw_count}")
+
+
+def write_questions(output_path: Path, ndjson_path: Path, questions: Iterable[Dict]) -> int:
+    """Escribe las preguntas al JSON del simulador a medida que llegan
+
+    En la misma pasada escribe una copia ND-JSON (una pregunta por línea)
+    para lectores en streaming. Se escribe a archivos temporales que solo
+    reemplazan a los anteriores si hubo preguntas. Devuelve cuántas se
+    escribieron.
+    """
+    tmp_path = output_path.with_suffix(".json.tmp")
+    ndjson_tmp_path = ndjson_path.with_suffix(".ndjson.tmp")
+    total = 0
+    with open(tmp_path, 'wb') as f, open(ndjson_tmp_path, 'wb') as nd:
+        f.write(OUTPUT_HEADER)
+        for q in questions:
+            f.write(b',' + RECORD_INDENT if total else RECORD_INDENT)
+            # orjson escapa los saltos de línea dentro de strings: todo '\n' es de la indentación
+            f.write(orjson.dumps(q, option=orjson.OPT_INDENT_2).replace(b'\n', RECORD_INDENT))
+            nd.write(orjson.dumps(q, option=orjson.OPT_APPEND_NEWLINE))
+            total += 1
+        f.write(OUTPUT_FOOTER)
+
+    if total:
+        os.replace(tmp_path, output_path)
+        os.replace(ndjson_tmp_path, ndjson_path)
+    else:
+        tmp_path.unlink()
+        ndjson_tmp_path.unlink()
+    return total
 
-    if not all_questions:
+
+def merge_questions():
+    """Combina todas las preguntas disponibles"""
+
+    print("🔄 Combinando preguntas para el simulador")
+    print("="*70)
+
+    # Cargar, formatear y guardar en streaming (sin materializar la lista completa)
+    domain_count = Counter()
+    source_count = Counter()
+    output_path = DATA_DIR / "questions.json"
+    ndjson_path = DATA_DIR / "questions.ndjson"
+    total = write_questions(output_path, ndjson_path,
+                            format_for_simulator(iter_source_questions(), domain_count, source_count))
+
+    if not total:
         print("\n❌ No se encontraron preguntas para combinar")
         print("\nEjecuta primero:")
         print("   python scripts/6_parse_real_questions.py")
         print("   python scripts/4_generate_questions.py --count 100")
         sys.exit(1)
 
-    # 4. Formatear para simulador
-    formatted = format_for_simulator(all_questions)
-
-    # 5. Guardar
-    output_path = DATA_DIR / "questions.json"
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(formatted, f, indent=2, ensure_ascii=False)
-
     # 6. Resumen
     print("\n" + "="*70)
     print("✅ COMBINACIÓN COMPLETADA")
     print("="*70)
-    print(f"Total de preguntas: {len(all_questions)}")
+    print(f"Total de preguntas: {total}")
     print(f"Guardado en: {output_path}")
+    print(f"ND-JSON (una pregunta por línea): {ndjson_path}")
 
     # Distribución por dominio
-    domain_count = {}
-    source_count = {}
-
-    for q in all_questions:
-        domain = q.get('domain', 'Unknown')
-        domain_count[domain] = domain_count.get(domain, 0) + 1
-
-        source = q.get('source', 'generated')
-        source_count[source] = source_count.get(source, 0) + 1
-
     print("\n📊 Distribución por dominio:")
     for domain, count in sorted(domain_count.items()):
-        pct = (count / len(all_questions)) * 100
+        pct = (count / total) * 100
         print(f"   • {domain}: {count} ({pct:.1f}%)")
 
     print("\n📚 Distribución por fuente:")
     for source, count in sorted(source_count.items()):
-        pct = (count / len(all_questions)) * 100
+        pct = (count / total) * 100
         print(f"   • {source}: {count} ({pct:.1f}%)")
 
     print("\n🚀 Siguiente paso:")
@@ -139,7 +194,7 @@ def merge_questions():
     print("   git commit -m 'Actualizar preguntas con contenido real validado'")
     print("   git push origin main")
 
-    return formatted
+    return total
 
 
 if __name__ == "__main__":